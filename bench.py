@@ -0,0 +1,303 @@
+import argparse
+import http.client
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+# load test for /updateBinary and /updateSpiffs
+#
+#   python bench.py                      spawns server.py against a synthetic /data
+#   python bench.py --url http://host:8080   hammers a server that's already running
+#
+# the synthetic manifest (and the version headers we send) match what's in it,
+# so a --url server needs to have been started on a --data dir made by --keep
+
+HARDWARE=["wemosD1","sonoff_basic","esp32_cam"]
+
+# (channel, tag) that the synthetic manifest offers
+RELEASE_TAG="v1.2.0"
+NIGHTLY_TAG="v1.3.0.nightly"
+
+# roughly what the real images weigh
+BIN_SIZE=480*1024
+SPIFFS_SIZE=1024*1024
+
+# case -> (expected status, description)
+CASES={
+    "current":(304,"device already on the release tag"),
+    "upgrade_bin":(200,"older device fetching its binary"),
+    "upgrade_spiffs":(200,"older device fetching its spiffs"),
+    "upgrade_nightly":(200,"older device on the nightly channel"),
+    "wrong_agent":(403,"not the esp updater"),
+    "malformed":(406,"unparseable X-Esp8266-Version"),
+    "no_candidate":(500,"hardware we've no image for"),
+}
+
+# path -> a key its json answer must carry, checked before the load starts
+SMOKE=[
+    # a resume point from before the feed began, so it answers at once rather than long polling
+    ("/changes?since=-1","seq"),
+    # what cluster peers read to split the devices between them
+    ("/cluster","seen"),
+]
+
+DEFAULT_MIX="current:70,upgrade_bin:12,upgrade_spiffs:5,upgrade_nightly:3,wrong_agent:3,malformed:4,no_candidate:3"
+
+
+def buildData(datadir, port):
+
+    # a manifest laid out the way the server publishes one
+    rng=random.Random(1)
+
+    manifest={}
+    for channel, tag in [("releases",RELEASE_TAG),("nightly",NIGHTLY_TAG)]:
+
+        folder="{}-{}-bench".format(channel,tag)
+        os.makedirs(os.path.join(datadir,folder))
+
+        files=[]
+        for hardware in HARDWARE:
+            for kind, size in [("bin",BIN_SIZE),("spiffs",SPIFFS_SIZE)]:
+                name="{}-{}.{}".format(hardware,tag,kind)
+                with open(os.path.join(datadir,folder,name),"wb") as fd:
+                    fd.write(rng.randbytes(size))
+                files.append(name)
+
+        manifest[channel]={ "tag_name":tag, "files":files, "dir":folder }
+
+    with open(os.path.join(datadir,"server_config.json"),"w") as fd:
+        json.dump({ "manifest":manifest }, fd, indent=4)
+
+    # admit every client, refused transfers would show up as unexpected 503s
+    options={ "host":"localhost", "logging":"WARNING", "nightly":True, "release":True, "port":port, "poll":15, "offline":True, "transfer_limit":256 }
+    with open(os.path.join(datadir,"options.json"),"w") as fd:
+        json.dump(options, fd, indent=4)
+
+
+def freePort():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1",0))
+        return sock.getsockname()[1]
+
+
+def spawnServer(datadir):
+
+    env=dict(os.environ)
+    env["ESP_UPDATE_DATA"]=datadir
+
+    server=os.path.join(os.path.dirname(os.path.abspath(__file__)),"server.py")
+    return subprocess.Popen([sys.executable, server], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def waitForServer(host, port, timeout):
+
+    deadline=time.time()+timeout
+    while time.time()<deadline:
+        try:
+            conn=http.client.HTTPConnection(host, port, timeout=2)
+            conn.request("GET","/version")
+            if conn.getresponse().status==200:
+                return True
+        except OSError:
+            pass
+        time.sleep(0.2)
+    return False
+
+
+def smokeCheck(host, port):
+
+    # the json endpoints, so a broken one fails the run rather than going unnoticed under load
+    failures=[]
+    for path, key in SMOKE:
+        try:
+            conn=http.client.HTTPConnection(host, port, timeout=10)
+            conn.request("GET", path)
+            response=conn.getresponse()
+            body=response.read()
+            conn.close()
+            if response.status!=200:
+                failures.append("{} answered {}".format(path,response.status))
+            elif key not in json.loads(body):
+                failures.append("{} has no {}".format(path,key))
+        except (OSError, http.client.HTTPException, ValueError) as e:
+            failures.append("{} failed {}".format(path,e))
+    return failures
+
+
+def requestFor(case, rng):
+
+    # (path, headers) a device in this situation would send
+    hardware=rng.choice(HARDWARE)
+    headers={ "User-Agent":"ESP8266-http-Update", "X-Esp8266-Version":"{}|v1.0.{}".format(hardware,rng.randint(0,9)), "X-Esp8266-Sta-Mac":"5C:CF:7F:00:00:{:02X}".format(rng.randint(0,255)) }
+    path="/updateBinary"
+
+    if case=="current":
+        headers["X-Esp8266-Version"]="{}|{}".format(hardware,RELEASE_TAG)
+    elif case=="upgrade_spiffs":
+        path="/updateSpiffs"
+    elif case=="upgrade_nightly":
+        path="/updateBinary?nightly=true"
+    elif case=="wrong_agent":
+        headers["User-Agent"]="curl/8.0"
+    elif case=="malformed":
+        headers["X-Esp8266-Version"]=hardware+"-1.0"
+    elif case=="no_candidate":
+        headers["X-Esp8266-Version"]="esp8285_unknown|v1.0.0"
+
+    return path, headers
+
+
+def client(host, port, mix, deadline, remaining, results, seed):
+
+    rng=random.Random(seed)
+    cases=[x[0] for x in mix]
+    weights=[x[1] for x in mix]
+
+    conn=http.client.HTTPConnection(host, port, timeout=60)
+
+    while time.time()<deadline:
+
+        if remaining is not None:
+            with remaining["lock"]:
+                if remaining["count"]<=0:
+                    break
+                remaining["count"]-=1
+
+        case=rng.choices(cases, weights)[0]
+        path, headers = requestFor(case, rng)
+
+        started=time.perf_counter()
+        try:
+            conn.request("GET", path, headers=headers)
+            response=conn.getresponse()
+            body=response.read()
+            status=response.status
+            if response.getheader("Connection","").lower()=="close":
+                conn.close()
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            status=None
+            body=b""
+
+        results.append((case, status, time.perf_counter()-started, len(body)))
+
+    conn.close()
+
+
+def percentile(ordered, fraction):
+    if len(ordered)==0:
+        return 0.0
+    return ordered[min(len(ordered)-1,int(fraction*len(ordered)))]
+
+
+def summarise(name, rows, elapsed, expected=None):
+
+    latencies=sorted(x[2] for x in rows)
+    served=sum(x[3] for x in rows)
+    unexpected=len([x for x in rows if expected is not None and x[1]!=expected])
+
+    return { "case":name, "requests":len(rows), "rps":len(rows)/elapsed, "p50_ms":percentile(latencies,0.5)*1000, "p99_ms":percentile(latencies,0.99)*1000,
+            "bytes_per_s":served/elapsed, "unexpected":unexpected }
+
+
+def report(summaries):
+
+    print("{:<16} {:>9} {:>10} {:>9} {:>9} {:>12} {:>10}".format("case","requests","req/s","p50 ms","p99 ms","MB/s","unexpected"))
+    for each in summaries:
+        print("{:<16} {:>9} {:>10.1f} {:>9.2f} {:>9.2f} {:>12.2f} {:>10}".format(each["case"],each["requests"],each["rps"],each["p50_ms"],each["p99_ms"],each["bytes_per_s"]/(1024*1024),each["unexpected"]))
+
+
+def main():
+
+    parser=argparse.ArgumentParser(description="Load test the firmware serving endpoints")
+    parser.add_argument("--url", help="server to test, otherwise one is spawned on a synthetic data dir")
+    parser.add_argument("--data", help="where to build the synthetic data dir (default: a temp dir)")
+    parser.add_argument("--keep", action="store_true", help="leave the synthetic data dir behind")
+    parser.add_argument("--clients", type=int, default=32, help="concurrent clients")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to run for")
+    parser.add_argument("--requests", type=int, help="stop after this many requests")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="case:weight,... from "+",".join(CASES))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="print the summary as json")
+    args=parser.parse_args()
+
+    mix=[]
+    for each in args.mix.split(","):
+        case, _, weight = each.partition(":")
+        if case not in CASES:
+            parser.error("unknown case "+case)
+        mix.append((case, float(weight or 1)))
+
+    process=None
+    datadir=None
+
+    if args.url is None:
+        datadir=args.data or tempfile.mkdtemp(prefix="espbench-")
+        os.makedirs(datadir, exist_ok=True)
+        host, port = "127.0.0.1", freePort()
+        buildData(datadir, port)
+        process=spawnServer(datadir)
+    else:
+        parsed=urllib.parse.urlparse(args.url)
+        host, port = parsed.hostname, parsed.port or 80
+
+    try:
+        if not waitForServer(host, port, 30):
+            print("server at {}:{} didn't come up".format(host,port), file=sys.stderr)
+            return 1
+
+        failures=smokeCheck(host, port)
+        if len(failures):
+            for each in failures:
+                print(each, file=sys.stderr)
+            return 1
+
+        results=[]
+        remaining={ "count":args.requests, "lock":threading.Lock() } if args.requests is not None else None
+        deadline=time.time()+args.duration
+
+        threads=[threading.Thread(target=client, args=(host, port, mix, deadline, remaining, results, args.seed+i)) for i in range(args.clients)]
+
+        started=time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed=time.perf_counter()-started
+
+        summaries=[summarise(case, [x for x in results if x[0]==case], elapsed, CASES[case][0]) for case, _ in mix]
+        summaries.append(summarise("all", results, elapsed))
+        summaries[-1]["unexpected"]=sum(x["unexpected"] for x in summaries[:-1])
+
+        if args.json:
+            print(json.dumps({ "clients":args.clients, "elapsed":elapsed, "cases":summaries }, indent=4))
+        else:
+            print("{} clients, {:.1f}s, {} requests".format(args.clients, elapsed, len(results)))
+            report(summaries)
+
+        return 0
+
+    finally:
+        if process is not None:
+            process.terminate()
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if datadir is not None and args.data is None:
+            if args.keep:
+                print("synthetic data left in "+datadir, file=sys.stderr)
+            else:
+                shutil.rmtree(datadir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,6 +4,8 @@ import threading
 import os
 import signal
 import requests
+import requests.adapters
+import urllib3
 import shutil
 import tarfile
 import time
@@ -11,16 +13,910 @@ import logging
 import re
 import sys
 import zipfile
-from zeroconf import ServiceBrowser, Zeroconf
-
-DATA_STEM="/data"
-
-CONFIG_FILE="/data/server_config.json"
-HA_ADDON_CONFIG_FILE="/data/options.json"
+import functools
+import asyncio
+import hashlib
+import gzip
+import tempfile
+import collections
+import bisect
+import math
+from concurrent.futures import ThreadPoolExecutor
+from zeroconf import IPVersion, ServiceStateChange
+from zeroconf.asyncio import AsyncServiceBrowser, AsyncServiceInfo, AsyncZeroconf
+
+# /data unless told otherwise, so benchmarks and local test servers can run side by side
+DATA_STEM=os.environ.get("ESP_UPDATE_DATA","/data")
+
+CONFIG_FILE=os.path.join(DATA_STEM,"server_config.json")
+HA_ADDON_CONFIG_FILE=os.path.join(DATA_STEM,"options.json")
+GITHUB_CACHE_FILE=os.path.join(DATA_STEM,"github_cache.json")
+# extracted images, stored once each by content - /data/blobs/<sha256[:2]>/<sha256>
+BLOB_DIR=os.path.join(DATA_STEM,"blobs")
 
 #LOG_FILE=DATA_STEM+"./server.log"
 LOG_FILE=None
 
+# v1.2.3, optionally followed by a .nightly / -rc1 style suffix
+VERSION_RE=re.compile("v(\\d+)\\.(\\d+)\\.(\\d+)[\\.-]*(.*)")
+# the parts of a suffix, compared as numbers or as words
+VERSION_SUFFIX_RE=re.compile("\\d+|[^\\d.\\-_+]+")
+
+# firmware kinds we serve, by file extension
+FIRMWARE_KINDS=("bin","spiffs")
+
+# (connect, read) seconds for anything we ask of github
+GITHUB_TIMEOUT=(10,60)
+# concurrent requests, and kept-alive connections per host, to github
+GITHUB_POOL=8
+# api calls a poll costs, used to spread our remaining quota
+GITHUB_REQUESTS_PER_POLL=3
+# items per page when listing releases and artifacts
+GITHUB_PAGE_SIZE=50
+# most pages a sync will walk, the first sync on a busy repo stops here
+GITHUB_MAX_PAGES=10
+# newest releases remembered between polls
+RELEASES_KEPT=20
+
+MDNS_SERVICE="_barneyman._tcp.local."
+# concurrent mdns resolutions, a fleet reboot announces everything at once
+MDNS_RESOLVE_CONCURRENCY=16
+# seconds to let a device's burst of announcements settle before resolving it
+MDNS_DEBOUNCE=1.0
+# milliseconds to wait for a resolution
+MDNS_RESOLVE_TIMEOUT=3000
+
+# how long stopPoller waits for each worker thread
+SHUTDOWN_TIMEOUT=15
+
+# new sets are extracted into /data/.staging-xxxx before they're published
+STAGING_PREFIX=".staging-"
+
+# bytes per write when transfers are paced to transfer_budget_kb
+TRANSFER_CHUNK=64*1024
+# most we'll tell a refused device to wait, in seconds
+TRANSFER_RETRY_MAX=60
+# seconds past its Retry-After that a refused device keeps its place in the queue
+TRANSFER_QUEUE_GRACE=10
+
+# seconds a device is told to wait while firmware we skipped is fetched for it
+DEFERRED_RETRY=60
+
+# points each cluster node gets on the ownership ring, more spreads devices more evenly
+CLUSTER_VNODES=160
+# a blob's name, its sha256
+BLOB_RE=re.compile("[0-9a-f]{64}")
+
+# changes kept for clients resuming /changes, older than this and they start again from /manifest and /hosts
+CHANGES_KEPT=1024
+# seconds a /changes long poll waits for something to happen
+CHANGES_LONG_POLL=30
+# seconds between keep-alive comments on an event stream
+CHANGES_KEEPALIVE=15
+
+# nightly zips are spooled in memory up to this size, then to a private temp file
+ARTIFACT_SPOOL=16*1024*1024
+
+# options that may be missing from an older options.json
+HA_OPTION_DEFAULTS={
+    # serve what's in the manifest, never ask github for more
+    "offline":False,
+    # devices asked to upgrade per wave
+    "rollout_wave":10,
+    # parallel /json/upgrade calls within a wave
+    "rollout_workers":5,
+    # firmware downloads allowed in flight before the next wave starts
+    "rollout_downloads":10,
+    # seconds between waves
+    "rollout_wave_pause":5,
+    # longest we'll wait for downloads to drain before starting a wave anyway
+    "rollout_download_wait":120,
+    # keep a gzipped copy of each image, for devices that can flash one
+    "gzip":False,
+    # hardware families whose firmware can flash a gzipped image ...
+    "gzip_hardware":["wemosD1","sonoff_basic"],
+    # ... from this version on
+    "gzip_min_version":"v0.0.0",
+    # megabytes of superseded tags kept for rollback, on top of what's live
+    "history_mb":200,
+    # base urls of every server in the cluster, this one included - empty runs standalone
+    "cluster_nodes":[],
+    # which of cluster_nodes this server is
+    "cluster_self":"",
+    # the node that polls github, the others mirror it - the first of cluster_nodes if not given
+    "cluster_leader":"",
+    # firmware transfers sent at once, more are told to come back later
+    "transfer_limit":8,
+    # kilobytes a second shared by all transfers, 0 for no limit
+    "transfer_budget_kb":0,
+    # server threads kept for everything that isn't a firmware transfer
+    "control_threads":10,
+    # /changes streams and long polls held at once, out of control_threads - more are told to come back later
+    "changes_limit":4,
+    # hardware families always extracted, on top of those we've seen on the network
+    "hardware":[],
+}
+
+
+# seconds, for request latencies
+LATENCY_BUCKETS=(0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10,30,60)
+# seconds, for polls, extraction and rollouts
+SLOW_BUCKETS=(1,5,10,30,60,120,300,600,1800,3600)
+
+
+class Metrics:
+    # counters and histograms in prometheus text format - a lock and a dict update, cheap enough for the hot path
+
+    def __init__(self):
+        self._lock=threading.Lock()
+        self._families={}
+        self._gauges={}
+
+    def counter(self, name, help):
+        self._families[name]={ "type":"counter", "help":help, "values":{} }
+
+    def histogram(self, name, help, buckets):
+        self._families[name]={ "type":"histogram", "help":help, "buckets":buckets, "values":{} }
+
+    def gauge(self, name, help, fn):
+        # read when scraped
+        self._gauges[name]={ "help":help, "fn":fn }
+
+    def inc(self, name, amount=1, **labels):
+        key=tuple(sorted(labels.items()))
+        values=self._families[name]["values"]
+        with self._lock:
+            values[key]=values.get(key,0)+amount
+
+    def observe(self, name, value, **labels):
+        key=tuple(sorted(labels.items()))
+        family=self._families[name]
+        with self._lock:
+            series=family["values"].get(key)
+            if series is None:
+                series=family["values"][key]={ "buckets":[0]*len(family["buckets"]), "sum":0.0, "count":0 }
+            for i, bound in enumerate(family["buckets"]):
+                if value<=bound:
+                    series["buckets"][i]+=1
+                    break
+            series["sum"]+=value
+            series["count"]+=1
+
+    def render(self):
+
+        lines=[]
+
+        with self._lock:
+            for name, family in self._families.items():
+                lines.append("# HELP {} {}".format(name,family["help"]))
+                lines.append("# TYPE {} {}".format(name,family["type"]))
+                for key, series in family["values"].items():
+                    if family["type"]=="counter":
+                        lines.append("{}{} {}".format(name,_labels(key),series))
+                        continue
+                    cumulative=0
+                    for bound, count in zip(family["buckets"],series["buckets"]):
+                        cumulative+=count
+                        lines.append("{}_bucket{} {}".format(name,_labels(key+(("le",repr(float(bound))),)),cumulative))
+                    lines.append("{}_bucket{} {}".format(name,_labels(key+(("le","+Inf"),)),series["count"]))
+                    lines.append("{}_sum{} {}".format(name,_labels(key),series["sum"]))
+                    lines.append("{}_count{} {}".format(name,_labels(key),series["count"]))
+
+        for name, gauge in self._gauges.items():
+            lines.append("# HELP {} {}".format(name,gauge["help"]))
+            lines.append("# TYPE {} gauge".format(name))
+            lines.append("{} {}".format(name,gauge["fn"]()))
+
+        return "\n".join(lines)+"\n"
+
+
+def _labels(key):
+    if len(key)==0:
+        return ""
+    escaped=[(k,str(v).replace("\\","\\\\").replace("\"","\\\"").replace("\n","\\n")) for k,v in key]
+    return "{"+",".join('{}="{}"'.format(k,v) for k,v in escaped)+"}"
+
+
+metrics=Metrics()
+metrics.counter("espupdate_http_requests_total","Firmware requests by endpoint and status")
+metrics.histogram("espupdate_http_request_seconds","Firmware request latency, including the transfer",LATENCY_BUCKETS)
+metrics.counter("espupdate_served_bytes_total","Firmware bytes served by channel, hardware and kind")
+metrics.counter("espupdate_github_requests_total","Github requests by call and status")
+metrics.counter("espupdate_transfers_refused_total","Firmware requests turned away by the transfer limit")
+metrics.counter("espupdate_changes_refused_total","/changes requests turned away by the changes limit")
+metrics.counter("espupdate_cluster_requests_total","Requests to the cluster leader by call and status")
+metrics.histogram("espupdate_github_request_seconds","Github time to response headers",LATENCY_BUCKETS)
+metrics.histogram("espupdate_gather_seconds","Time to gather releases and artifacts from github",SLOW_BUCKETS)
+metrics.histogram("espupdate_extract_seconds","Time to download and extract a new set",SLOW_BUCKETS)
+metrics.histogram("espupdate_rollout_seconds","Time to run a rollout",SLOW_BUCKETS)
+metrics.counter("espupdate_device_upgrades_total","Devices asked to upgrade, by outcome")
+
+
+class AdmissionController:
+    # firmware transfers in flight, capped at transfer_limit so they can't take every server thread
+    # a device over the cap is told when to come back, and is let in ahead of anyone who asked after it
+
+    def __init__(self, options):
+        self._options=options
+        self._lock=threading.Condition()
+        self._active=0
+        # client -> (position kept until), oldest first
+        self._queue=collections.OrderedDict()
+        # seconds a transfer takes, smoothed, to say how long to wait
+        self._transferSeconds=5.0
+        # the bandwidth budget, in bytes owed (negative) or banked
+        self._budget=threading.Lock()
+        self._tokens=0.0
+        self._filled=time.monotonic()
+
+    def admit(self, client):
+
+        # (True, 0) and the transfer is counted, or (False, place in the queue, seconds to wait)
+        now=time.time()
+        with self._lock:
+
+            for waiting in [x for x, until in self._queue.items() if until<now]:
+                del self._queue[waiting]
+
+            limit=max(1,self._options["transfer_limit"])
+
+            ahead=0
+            for waiting in self._queue:
+                if waiting==client:
+                    break
+                ahead+=1
+
+            # slots are held for those already queued
+            if self._active+ahead<limit:
+                self._queue.pop(client,None)
+                self._active+=1
+                return True, 0, 0
+
+            position=ahead+1
+            retry=max(1,min(TRANSFER_RETRY_MAX,math.ceil(position*self._transferSeconds/limit)))
+            # keeps its place if it's already queued
+            self._queue[client]=now+retry+TRANSFER_QUEUE_GRACE
+
+            return False, position, retry
+
+    def end(self, seconds=None):
+        with self._lock:
+            self._active-=1
+            if seconds is not None:
+                self._transferSeconds=0.8*self._transferSeconds+0.2*seconds
+            self._lock.notify_all()
+
+    def queued(self):
+        return len(self._queue)
+
+    def spend(self, amount):
+
+        # blocks long enough to keep all transfers together inside transfer_budget_kb
+        rate=self._options["transfer_budget_kb"]*1024
+        if rate<=0:
+            return
+
+        with self._budget:
+            now=time.monotonic()
+            self._tokens=min(rate, self._tokens+(now-self._filled)*rate)-amount
+            self._filled=now
+            owed=-self._tokens/rate
+
+        if owed>0:
+            time.sleep(owed)
+
+    def active(self):
+        return self._active
+
+    def waitForRoom(self, wanted, limit, timeout):
+        # block until 'wanted' more transfers fit under 'limit' (or nothing is running)
+        with self._lock:
+            return self._lock.wait_for(lambda: self._active+wanted<=limit or self._active==0, timeout)
+
+
+@functools.total_ordering
+class Version:
+    # v1.2.3[-suffix], ordered as semver orders them - a suffixed version (-rc1, .nightly) comes before the release
+    # immutable and hashable, get one from Version.parse, which caches
+
+    __slots__=("text","numbers","suffix","_key")
+
+    def __init__(self, text, numbers, suffix):
+        object.__setattr__(self,"text",text)
+        object.__setattr__(self,"numbers",numbers)
+        object.__setattr__(self,"suffix",suffix)
+
+        if suffix=="":
+            rank=((1,),)
+        else:
+            # rc2 before rc10, numbers before words
+            rank=((0,)+tuple((0,int(x),"") if x.isdigit() else (1,0,x) for x in VERSION_SUFFIX_RE.findall(suffix)),)
+        object.__setattr__(self,"_key",numbers+rank)
+
+    @staticmethod
+    def parse(vstring):
+        # None if it isn't a version
+        return _parseVersion(vstring)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Version is immutable")
+
+    def __eq__(self, other):
+        return isinstance(other, Version) and self._key==other._key
+
+    def __lt__(self, other):
+        if not isinstance(other, Version):
+            return NotImplemented
+        return self._key<other._key
+
+    def __hash__(self):
+        return hash(self._key)
+
+    def __str__(self):
+        return self.text
+
+    def __repr__(self):
+        return "Version({!r})".format(self.text)
+
+
+class HashRing:
+    # devices hashed onto cluster nodes, a node joining or leaving only moves its own share
+
+    def __init__(self, nodes, vnodes=CLUSTER_VNODES):
+        self._ring=sorted((_ringHash("{}#{}".format(node,i)), node) for node in nodes for i in range(vnodes))
+        self._points=[x[0] for x in self._ring]
+
+    def owner(self, key, among=None):
+        # the first node clockwise from key, skipping any not in among
+        at=bisect.bisect(self._points,_ringHash(key))
+        for step in range(len(self._ring)):
+            node=self._ring[(at+step)%len(self._ring)][1]
+            if among is None or node in among:
+                return node
+        return None
+
+
+class ChangeFeed:
+    # small deltas for dashboards, numbered so a client can pick up where it left off
+
+    def __init__(self):
+        self._lock=threading.Condition()
+        self._seq=0
+        self._kept=collections.deque(maxlen=CHANGES_KEPT)
+        self._closed=False
+
+    def publish(self, kind, **detail):
+        with self._lock:
+            self._seq+=1
+            detail.update({ "seq":self._seq, "type":kind, "time":time.time() })
+            self._kept.append(detail)
+            self._lock.notify_all()
+
+    def latest(self):
+        return self._seq
+
+    def since(self, seq):
+        # changes after seq, or None if we can't say (too old, or from before a restart)
+        with self._lock:
+            if seq>self._seq:
+                return None
+            if seq<self._seq and (len(self._kept)==0 or self._kept[0]["seq"]>seq+1):
+                return None
+            return [x for x in self._kept if x["seq"]>seq]
+
+    def wait(self, seq, timeout):
+        # True if there's something after seq
+        with self._lock:
+            return self._lock.wait_for(lambda: self._seq!=seq or self._closed, timeout) and not self._closed
+
+    def closed(self):
+        return self._closed
+
+    def close(self):
+        # wakes anyone waiting, so streams finish at shutdown
+        with self._lock:
+            self._closed=True
+            self._lock.notify_all()
+
+
+class FirmwareCache:
+    # the handful of images we're offering, held in memory - a rollout serves them hundreds of times
+
+    def __init__(self):
+        self._lock=threading.Lock()
+        self._blobs={}
+
+    def load(self, path, stamp):
+
+        # stamp is (size, mtime) - a changed file is re-read
+        with self._lock:
+            cached=self._blobs.get(path)
+            if cached is not None and cached[0]==stamp:
+                return cached[1]
+
+        with open(path,"rb") as fd:
+            data=fd.read()
+
+        with self._lock:
+            self._blobs[path]=(stamp,data)
+
+        return data
+
+    def evict(self, path):
+        with self._lock:
+            if self._blobs.pop(path,None) is not None:
+                logger.debug("Evicted %s from the firmware cache",path)
+
+    def retain(self, paths):
+        # drop everything the index no longer points at
+        with self._lock:
+            for path in [x for x in self._blobs if x not in paths]:
+                logger.debug("Evicted %s from the firmware cache",path)
+                del self._blobs[path]
+
+    def size(self):
+        with self._lock:
+            return sum(len(x[1]) for x in self._blobs.values())
+
+
+class BlobStore:
+    # images keyed by their sha256, so a file shared by channels or tags is on disk once
+
+    def __init__(self, root):
+        self._root=root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, digest):
+        return os.path.join(self._root,digest[:2],digest)
+
+    def has(self, digest):
+        return os.path.isfile(self.path(digest))
+
+    def size(self, digest):
+        try:
+            return os.path.getsize(self.path(digest))
+        except OSError:
+            return 0
+
+    def ingest(self, path, digest=None):
+
+        # moves path into the store, or drops it if we already have those bytes
+        # digest if it has already been hashed, otherwise it is hashed here
+        if digest is None:
+            digest=_fileDigest(path)
+
+        target=self.path(digest)
+        if os.path.isfile(target):
+            logger.debug("Already have %s as %s",os.path.basename(path),digest)
+            os.unlink(path)
+        else:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(path, target)
+
+        return digest
+
+    def verify(self, digest, md5=None):
+
+        # True if we hold it intact, a damaged copy is removed so it gets fetched again
+        path=self.path(digest)
+        try:
+            actual=_fileHashes(path)
+            if actual[1]==digest and md5 in (None, actual[0]):
+                return True
+        except OSError:
+            return False
+
+        logger.error("blob %s is damaged, removing it",digest)
+        os.unlink(path)
+        return False
+
+    def collect(self, keep):
+
+        # remove everything not in keep
+        removed=0
+        freed=0
+        for prefix in os.listdir(self._root):
+            folder=os.path.join(self._root,prefix)
+            if not os.path.isdir(folder):
+                continue
+            for digest in os.listdir(folder):
+                if digest in keep:
+                    continue
+                path=os.path.join(folder,digest)
+                try:
+                    freed+=os.path.getsize(path)
+                    os.unlink(path)
+                    removed+=1
+                except OSError as e:
+                    logger.warning("couldn't remove blob %s - %s",digest,e)
+
+        if removed:
+            logger.info("Removed %s blobs, %s bytes",removed,freed)
+
+
+class ManifestStore:
+    # server_config.json - changed a channel at a time, always written whole via a temp file and rename
+    # so a crash mid-save leaves the last good copy, and /manifest is only re-serialised when it changes
+
+    def __init__(self, filename):
+
+        self._filename=filename
+        self._lock=threading.Lock()
+        self._rendered=None
+
+        self._data={ "manifest":{} }
+
+        if os.path.isfile(filename):
+            try:
+                with open(filename) as json_file:
+                    self._data=json.load(json_file)
+            except ValueError as e:
+                logger.error("%s is unreadable, starting with an empty manifest - %s",filename,e)
+        else:
+            logger.debug("Creating empty manifest")
+
+        self._data.setdefault("manifest",{})
+        # channel -> superseded nodes, newest first, still in the blob store for rollback
+        self._data.setdefault("history",{})
+
+    def data(self):
+        # readers only, changes go through setChannel / setValue
+        return self._data
+
+    def setChannel(self, channel, Node, history=None):
+        with self._lock:
+            # one assignment, readers see the old node or the new one
+            self._data["manifest"][channel]=Node
+            if history is not None:
+                self._data["history"]=history
+            self._commit()
+
+    def setValue(self, key, value):
+        with self._lock:
+            self._data[key]=value
+            self._commit()
+
+    def render(self):
+        rendered=self._rendered
+        if rendered is None:
+            with self._lock:
+                rendered=self._rendered=json.dumps(self._data, indent=4)
+        return rendered
+
+    def _commit(self):
+
+        self._rendered=None
+
+        staged=self._filename+".tmp"
+        with open(staged, 'w') as outfile:
+            json.dump(self._data, outfile, indent=4)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        os.replace(staged, self._filename)
+
+
+class DeviceRegistry:
+    # the fleet as mdns (and update requests) tell us about it, indexed by service name, server, mac and address
+
+    def __init__(self, changes):
+        self._lock=threading.Lock()
+        self._changes=changes
+        # bumped on every change, so readers can cache what they make of a snapshot
+        self._generation=0
+        self._byName={}
+        self._byServer={}
+        self._byMac={}
+        self._byAddress={}
+
+    def upsert(self, name, server, address, version=None, mac=None):
+
+        # returns True if this is a device we didn't know
+        with self._lock:
+
+            host=self._byServer.get(server) or self._byName.get(name)
+            added=host is None
+            previous=None
+
+            if added:
+                host={ "name":name, "server":server }
+            else:
+                previous=host.get("version")
+                self._unindex(host)
+                host["name"]=name
+                host["server"]=server
+
+            host["address"]=address
+            if version is not None:
+                host["version"]=version
+            if mac is not None:
+                host["mac"]=mac
+            host["last_seen"]=time.time()
+
+            self._index(host)
+            self._generation+=1
+            current=dict(host)
+
+        if added:
+            self._changes.publish("device_added", host=current)
+        elif version is not None and version!=previous:
+            self._changes.publish("device_version", name=name, server=server, previous=previous, version=version)
+
+        return added
+
+    def remove(self, name):
+
+        with self._lock:
+            host=self._byName.get(name)
+            if host is None:
+                return None
+            self._unindex(host)
+            self._generation+=1
+
+        self._changes.publish("device_removed", name=name, server=host["server"])
+        return dict(host)
+
+    def heardFrom(self, address, mac):
+
+        # a device asking for an update tells us its mac, tie it to the mdns record
+        with self._lock:
+            host=self._byMac.get(mac) if mac is not None else None
+            if host is None:
+                host=self._byAddress.get(address)
+            if host is None:
+                return
+            self._unindex(host)
+            if mac is not None:
+                host["mac"]=mac
+            host["last_seen"]=time.time()
+            self._index(host)
+            self._generation+=1
+
+    def byMac(self, mac):
+        with self._lock:
+            host=self._byMac.get(mac)
+            return dict(host) if host is not None else None
+
+    def snapshot(self):
+        # copies, so callers can walk them while mdns carries on changing things
+        with self._lock:
+            return [dict(x) for x in self._byName.values()]
+
+    def generation(self):
+        return self._generation
+
+    def __len__(self):
+        return len(self._byName)
+
+    def _index(self, host):
+        self._byName[host["name"]]=host
+        self._byServer[host["server"]]=host
+        self._byAddress[host["address"]]=host
+        if "mac" in host:
+            self._byMac[host["mac"]]=host
+
+    def _unindex(self, host):
+        for index, key in [(self._byName,host["name"]), (self._byServer,host["server"]), (self._byAddress,host["address"]), (self._byMac,host.get("mac"))]:
+            if index.get(key) is host:
+                del index[key]
+
+
+class GithubCache:
+    # github responses kept on disk with their validators, and what github tells us about our quota
+
+    def __init__(self, filename):
+
+        self._filename=filename
+        self._lock=threading.Lock()
+        self._entries={}
+        # where the last sync got to, so the next only asks for what's new
+        self._sync={}
+        self._dirty=False
+
+        self._remaining=None
+        self._reset=None
+        self._notBefore=0
+
+        if os.path.isfile(filename):
+            try:
+                with open(filename) as json_file:
+                    saved=json.load(json_file)
+                # from before sync state was kept, it's all responses
+                if "entries" not in saved:
+                    saved={ "entries":saved }
+                self._entries=saved["entries"]
+                self._sync=saved.get("sync",{})
+            except ValueError as e:
+                logger.warning("Ignoring unreadable github cache %s",e)
+
+    def conditionalHeaders(self, url):
+
+        headers={}
+        with self._lock:
+            entry=self._entries.get(url)
+        if entry is not None:
+            if entry.get("etag") is not None:
+                headers["If-None-Match"]=entry["etag"]
+            if entry.get("last_modified") is not None:
+                headers["If-Modified-Since"]=entry["last_modified"]
+        return headers
+
+    def cached(self, url):
+        with self._lock:
+            return self._entries[url]["body"]
+
+    def store(self, url, headers, body):
+
+        if headers.get("ETag") is None and headers.get("Last-Modified") is None:
+            return
+
+        with self._lock:
+            self._entries[url]={ "etag":headers.get("ETag"), "last_modified":headers.get("Last-Modified"), "body":body }
+            self._dirty=True
+
+    def save(self):
+
+        with self._lock:
+            if not self._dirty:
+                return
+            staged=self._filename+".tmp"
+            with open(staged, 'w') as outfile:
+                json.dump({ "entries":self._entries, "sync":self._sync }, outfile)
+            os.replace(staged, self._filename)
+            self._dirty=False
+
+    def syncState(self, name):
+        with self._lock:
+            return self._sync.get(name)
+
+    def setSyncState(self, name, state):
+        with self._lock:
+            self._sync[name]=state
+            self._dirty=True
+
+    def noteLimits(self, headers):
+
+        now=time.time()
+
+        with self._lock:
+
+            # secondary limits come with a Retry-After
+            retryAfter=headers.get("Retry-After")
+            if retryAfter is not None and retryAfter.isdigit():
+                self._notBefore=max(self._notBefore, now+int(retryAfter))
+
+            remaining=headers.get("X-RateLimit-Remaining")
+            reset=headers.get("X-RateLimit-Reset")
+            if remaining is not None and reset is not None:
+                try:
+                    self._remaining=int(remaining)
+                    self._reset=float(reset)
+                except ValueError:
+                    return
+                if self._remaining==0:
+                    self._notBefore=max(self._notBefore, self._reset)
+
+    def ready(self):
+        return time.time()>=self._notBefore
+
+    def notBefore(self):
+        return self._notBefore
+
+    def nextPoll(self, lastPoll, interval):
+
+        # when the next poll is due, stretched so what's left of our quota lasts until github resets it
+        due=lastPoll+interval
+
+        with self._lock:
+            if self._remaining is not None and self._reset is not None and self._reset>lastPoll:
+                polls=self._remaining//GITHUB_REQUESTS_PER_POLL
+                if polls<1:
+                    due=max(due, self._reset)
+                else:
+                    due=max(due, lastPoll+(self._reset-lastPoll)/polls)
+
+            return max(due, self._notBefore)
+
+
+class RolloutScheduler:
+    # asks devices to upgrade in waves through a bounded worker pool, off the poller thread
+
+    def __init__(self, upgrade, hostsProvider, transfers, options, changes):
+
+        self._upgrade=upgrade
+        self._hostsProvider=hostsProvider
+        self._transfers=transfers
+        self._options=options
+        self._changes=changes
+
+        self._lock=threading.Lock()
+        self._running=False
+        self._pending=False
+        self._stop=threading.Event()
+        self._thread=None
+
+        self._status={ "state":"idle" }
+
+    def status(self):
+        return dict(self._status)
+
+    def request(self):
+        # start a rollout, or queue one to follow the rollout that's running
+        with self._lock:
+            if self._stop.is_set():
+                return False
+            if self._running:
+                logger.info("Rollout already running, another one queued")
+                self._pending=True
+                return False
+            self._running=True
+            self._pending=False
+
+        self._thread=threading.Thread(target=self._rollout_thread, args=())
+        self._thread.start()
+        return True
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _rollout_thread(self):
+
+        while True:
+
+            try:
+                self._rollout(self._hostsProvider())
+            except Exception as e:
+                logger.error("Rollout failed %s",e)
+
+            with self._lock:
+                if self._stop.is_set() or not self._pending:
+                    self._running=False
+                    return
+                self._pending=False
+
+    def _rollout(self, hosts):
+
+        waveSize=max(1,self._options["rollout_wave"])
+        waves=[hosts[i:i+waveSize] for i in range(0,len(hosts),waveSize)]
+
+        logger.info("Rollout to %s devices in %s waves",len(hosts),len(waves))
+
+        started=time.time()
+        self._status={ "state":"running", "started":started, "devices":len(hosts), "waves":len(waves), "wave":0, "asked":0, "failed":0 }
+        self._changes.publish("rollout", **self._status)
+
+        with ThreadPoolExecutor(max_workers=max(1,self._options["rollout_workers"])) as pool:
+
+            for number, wave in enumerate(waves, 1):
+
+                if self._stop.is_set():
+                    break
+
+                # don't pile a new wave on top of a pool of slow downloads
+                if not self._transfers.waitForRoom(len(wave), self._options["rollout_downloads"], self._options["rollout_download_wait"]):
+                    logger.warning("Rollout wave %s starting with %s downloads still running",number,self._transfers.active())
+
+                results=list(pool.map(self._upgrade, wave))
+
+                asked=results.count(True)
+                self._status["wave"]=number
+                self._status["asked"]+=asked
+                self._status["failed"]+=len(results)-asked
+                self._changes.publish("rollout", **self._status)
+
+                logger.info("Rollout wave %s/%s - %s asked, %s refused or unreachable",number,len(waves),asked,len(results)-asked)
+
+                if number<len(waves):
+                    self._stop.wait(self._options["rollout_wave_pause"])
+
+        self._status["state"]="stopped" if self._stop.is_set() else "done"
+        self._status["finished"]=time.time()
+        self._changes.publish("rollout", **self._status)
+
+        metrics.observe("espupdate_rollout_seconds", self._status["finished"]-started)
+
+        logger.info("Rollout %s after %.1fs, %s asked, %s failed",self._status["state"],time.time()-started,self._status["asked"],self._status["failed"])
 
 
 class RepoReleases:
@@ -34,23 +930,79 @@ class RepoReleases:
         self._prereleases=[]
         self._nightly=[]
 
-        self._fetch_running=False
-        self._stop=False
-        self._polling=False
+        # set to stop the threads, and to wake the poller early
+        self._stop=threading.Event()
+        self._wake=threading.Event()
+
         self._streaming=False
         self._updatePending=False
 
-        self._mdnshosts=[]
+        self._changes=ChangeFeed()
+        self._devices=DeviceRegistry(self._changes)
+        self._hostsRendered=None
+
+        # one keep-alive pool for everything we fetch from github
+        self._session=requests.Session()
+        adapter=requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=GITHUB_POOL)
+        self._session.mount("https://", adapter)
+
+        self._githubCache=GithubCache(GITHUB_CACHE_FILE)
+
+        # (firmware index, channel -> tag), always replaced as a pair
+        self._served=({},{})
+        self._cache=FirmwareCache()
+        self._blobs=BlobStore(BLOB_DIR)
+        # publishes and rollbacks, one at a time
+        self._publishing=threading.RLock()
+
+        # hardware families we've skipped, fetched when a device turns up wanting one
+        self._familyLock=threading.Lock()
+        self._fetching=set()
+        self._lazy=ThreadPoolExecutor(max_workers=2)
 
         self.loadConfig()
 
-        self._zeroRunninng=False
-        self._poller = threading.Thread(target=self.fetchAssetsTimed_thread, args=())
-        self._zero_conf = threading.Thread(target=self.findDevices_thread, args=(2,))
+        self._tidy_staging()
+
+        # serve what we have straight away, unless it's damaged
+        self._verifyManifest()
+
+        # cluster mode - the leader polls github, followers mirror its manifest and blobs
+        nodes=self._haconfig["cluster_nodes"]
+        self._ring=HashRing(nodes)
+        # node -> the device names it can see, mdns doesn't cross sites
+        self._peerDevices={}
+        self._leader=(self._haconfig["cluster_leader"] or nodes[0]).rstrip("/") if len(nodes) else None
+        self._follower=self._leader is not None and self._leader!=self._haconfig["cluster_self"].rstrip("/")
+        if len(nodes) and self._haconfig["cluster_self"] not in nodes:
+            logger.error("cluster_self %s isn't one of cluster_nodes, no devices will be ours",self._haconfig["cluster_self"])
+
+        self._transfers=AdmissionController(self._haconfig)
+
+        # each /changes watcher holds a server thread, so they get a share and no more
+        self._watchLock=threading.Lock()
+        self._watching=0
+        if self._haconfig["changes_limit"]>=self._haconfig["control_threads"]:
+            logger.warning("changes_limit %s leaves none of the %s control_threads for anything else",self._haconfig["changes_limit"],self._haconfig["control_threads"])
+
+        metrics.gauge("espupdate_transfers_in_flight","Firmware transfers being sent",self._transfers.active)
+        metrics.gauge("espupdate_transfers_queued","Devices told to come back for their firmware",self._transfers.queued)
+        metrics.gauge("espupdate_changes_watchers","/changes streams and long polls being held",lambda: self._watching)
+        metrics.gauge("espupdate_devices","Devices known from mdns",lambda: len(self._devices))
+        metrics.gauge("espupdate_cache_bytes","Firmware held in memory",self._cache.size)
+        self._rollout=RolloutScheduler(self.upgradeDevice, self.rolloutHosts, self._transfers, self._haconfig, self._changes)
+
+        self._poller = threading.Thread(target=self.fetchAssetsTimed_thread, args=(), daemon=True)
+        self._zero_conf = threading.Thread(target=self.findDevices_thread, args=(2,), daemon=True)
 
         self._zero_conf.start()
         self._poller.start()
 
+        if self._follower:
+            logger.info("Following cluster leader %s",self._leader)
+            self._cluster = threading.Thread(target=self.followLeader_thread, args=(), daemon=True)
+            self._cluster.start()
+
 
         logger.critical("Setting logging to '%s'",self._haconfig["logging"])
 
@@ -60,15 +1012,16 @@ class RepoReleases:
 
     def loadConfig(self):
 
-        if os.path.isfile(CONFIG_FILE):
-            with open(CONFIG_FILE) as json_file:
-                self._config=json.load(json_file)        
-        else:
-            logger.debug("Creating empty manifest")
-            self._config={ "manifest":{} }
-
         self.loadHAconfig()
 
+        self._manifest=ManifestStore(CONFIG_FILE)
+        self._config=self._manifest.data()
+
+        # the hardware the fleet runs, as mdns and update requests have shown us
+        self._families=set(x for x in self._config.get("families",[]) if self.knownFamily(x))
+
+        self.buildFirmwareIndex()
+
 
     def loadHAconfig(self):
         # this file will be populated by HA when run as an addon
@@ -80,18 +1033,120 @@ class RepoReleases:
             logger.warning("Creating dev config")
             self._haconfig={ "host":"debian", "logging":"DEBUG","nightly":True, "release":True,"port":8080, "poll":15 }
 
+        for key, value in HA_OPTION_DEFAULTS.items():
+            self._haconfig.setdefault(key, value)
+
 
     def port(self):
         return self._haconfig["port"]
 
-    def saveConfig(self):
+    def saveChannel(self, asset_dir, Node, history=None):
+
+        self._manifest.setChannel(asset_dir, Node, history)
+
+        self.buildFirmwareIndex()
+
+    def buildFirmwareIndex(self):
+
+        # (channel, hardware, bin|spiffs) -> the file to serve, so requests don't scan the manifest
+        index={}
+        tags={}
+
+        for channel, Node in self._config["manifest"].items():
+
+            if "tag_name" not in Node:
+                continue
+
+            tags[channel]=Version.parse(Node["tag_name"])
+
+            for each in Node.get("files",[]):
+
+                dash=each.find("-")
+                kind=each[each.rfind(".")+1:]
+                if dash<1 or kind not in FIRMWARE_KINDS:
+                    continue
+
+                key=(channel, each[:dash], kind)
+                blobs=Node.get("blobs")
+                md5s=Node.get("md5",{})
+
+                if key in index:
+                    # should only be one candidate
+                    logger.warning("More than one %s %s %s in the manifest",*key)
+                    index[key]=None
+                    continue
+
+                previous=self._served[0].get(key)
+
+                if blobs is not None:
+                    entry=self._indexEntry(key, each, self._blobs.path(blobs.get(each,"-")), previous, blobs.get(each), md5s.get(each))
+                else:
+                    # a set from before the blob store
+                    entry=self._indexEntry(key, each, os.path.join(DATA_STEM,Node.get("dir",channel),each), previous)
+
+                if entry is None:
+                    logger.warning("%s %s is in the manifest but missing",channel,each)
+                    continue
+
+                # the gzipped copy, if ingest made one
+                if self._haconfig["gzip"]:
+                    gzPrevious=previous.get("gz") if previous is not None else None
+                    if blobs is not None:
+                        entry["gz"]=self._indexEntry(key, each+".gz", self._blobs.path(blobs.get(each+".gz","-")), gzPrevious, blobs.get(each+".gz"), md5s.get(each+".gz"))
+                    else:
+                        entry["gz"]=self._indexEntry(key, each+".gz", entry["path"]+".gz", gzPrevious)
+
+                index[key]=entry
+
+        # swap in whole and as one, request threads only ever see an index with the tags it was built from
+        self._served=(index, tags)
 
-        with open(CONFIG_FILE, 'w') as outfile:
-            json.dump(self._config, outfile, indent=4)
+        live=set()
+        for entry in index.values():
+            if entry is not None:
+                live.add(entry["path"])
+                if entry.get("gz") is not None:
+                    live.add(entry["gz"]["path"])
+        self._cache.retain(live)
 
+        logger.debug("Firmware index has %s entries, %s bytes cached",len(index),self._cache.size())
 
 
 
+
+    def _indexEntry(self, key, name, path, previous, digest=None, md5=None):
+
+        if not os.path.isfile(path):
+            return None
+
+        # only hash what's new or changed since the last index
+        stat=os.stat(path)
+        stamp=(stat.st_size,stat.st_mtime_ns)
+        data=self._cache.load(path, stamp)
+
+        entry={ "name":name, "path":path, "stamp":stamp, "key":key, "size":stamp[0] }
+
+        unchanged=previous is not None and previous["path"]==path and previous["stamp"]==stamp
+
+        if digest is not None:
+            # a blob is named for its hash already
+            entry["etag"]='"{}"'.format(digest)
+        elif unchanged:
+            entry["etag"]=previous["etag"]
+        else:
+            entry["size"]=len(data)
+            entry["etag"]='"{}"'.format(hashlib.sha256(data).hexdigest())
+
+        # sets from before we stored an md5 get one here, still only once
+        if md5 is not None:
+            entry["md5"]=md5
+        elif unchanged:
+            entry["md5"]=previous["md5"]
+        else:
+            entry["md5"]=hashlib.md5(data).hexdigest()
+
+        return entry
+
     # do this once-ish
     # fetch all available releases
     def gather(self):
@@ -103,25 +1158,17 @@ class RepoReleases:
         self._prereleases=[]
         self._nightly=[]
 
-        runs=self.FetchActionRuns()
-        nightlys=self.fetchActionArtifacts()
-
-        if nightlys is not None and runs is not None:
-        
-            lastRun=runs["workflow_runs"][0]
+        # these are independent, so a gather costs the slower of them
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            nightlys=pool.submit(self.syncNightly)
+            releases=pool.submit(self.syncReleases)
 
-            if lastRun["conclusion"]=="success" and lastRun["event"]=="push":
+        nightlys=nightlys.result()
+        releases=releases.result()
 
-                # now look for assets for it
-                for each in nightlys["artifacts"]:
-                    if each["workflow_run"]["id"]==lastRun["id"]:
-                        for types in ["wemosD1", "sonoff_basic", "esp32_cam"]:
-                            if each["name"].find(types)!=-1: 
-                                self._nightly.append(each)
-                                break
-
-        # this gets all pre/releases - draft too
-        releases=self.fetchListOfAllReleases()
+        # _download_artifacts picks the hardware we want
+        if nightlys is not None:
+            self._nightly=nightlys
 
         # walk thru them
         if releases is None:
@@ -150,187 +1197,628 @@ class RepoReleases:
         # v0.0.27
         url="https://api.github.com/repos/{}/{}/releases/{}".format(self._owner,self._repo,revision)
 
-        req=requests.get(url)
-        
-        if req.status_code==200:
-            return req.json()
+        return self.fetchGithubJson(url, "fetchSingleRelease")
 
-        logger.error("fetchSingleRelease : %s returned %s",url, req.status_code)
+    def fetchReleaseByTag(self, tag):
+        url="https://api.github.com/repos/{}/{}/releases/tags/{}".format(self._owner,self._repo,tag)
 
-        return None
+        return self.fetchGithubJson(url, "fetchReleaseByTag")
 
     def FetchActionRuns(self):
-        url="https://api.github.com/repos/{}/{}/actions/runs".format(self._owner,self._repo)
+        # only the newest successful push build is of any use to us
+        url="https://api.github.com/repos/{}/{}/actions/runs?event=push&status=success&per_page=1".format(self._owner,self._repo)
 
-        # get that as json
-        req=requests.get(url)
-        
-        if req.status_code==200:
-            return req.json()
+        return self.fetchGithubJson(url, "FetchActionRuns")
 
-        logger.error("FetchActionRuns : %s returned %s",url, req.status_code)
-        return None
+    def fetchRunArtifacts(self, run, page):
+        # build the url
+        url="https://api.github.com/repos/{}/{}/actions/runs/{}/artifacts?per_page={}&page={}".format(self._owner,self._repo,run,GITHUB_PAGE_SIZE,page)
 
-    def fetchActionArtifacts(self):
+        return self.fetchGithubJson(url, "fetchRunArtifacts")
+
+    def fetchListOfAllReleases(self, page=1):
         # build the url
-        url="https://api.github.com/repos/{}/{}/actions/artifacts".format(self._owner,self._repo)
+        url="https://api.github.com/repos/{}/{}/releases?per_page={}&page={}".format(self._owner,self._repo,GITHUB_PAGE_SIZE,page)
 
-        # get that as json
-        req=requests.get(url)
-        
-        if req.status_code==200:
-            return req.json()
+        return self.fetchGithubJson(url, "fetchListOfAllReleases")
 
-        logger.error("fetchActionArtifacts : %s returned %s",url, req.status_code)
-        return None
+    def syncNightly(self):
 
+        # the newest build's artifacts, only listed again when there's a newer build
+        runs=self.FetchActionRuns()
+        if runs is None:
+            return None
 
-    def fetchListOfAllReleases(self):
-        # build the url
-        url="https://api.github.com/repos/{}/{}/releases".format(self._owner,self._repo)
+        if len(runs.get("workflow_runs",[]))==0:
+            return []
 
-        # get that as json
-        req=requests.get(url)
-        
-        if req.status_code==200:
-            return req.json()
+        lastRun=runs["workflow_runs"][0]
 
-        logger.error("fetchListOfAllReleases : %s returned %s",url, req.status_code)
+        known=self._githubCache.syncState("nightly")
+        if known is not None and known["run"]==lastRun["id"]:
+            return known["artifacts"]
 
-        return None
+        artifacts=[]
+        for page in range(1, GITHUB_MAX_PAGES+1):
+            listing=self.fetchRunArtifacts(lastRun["id"], page)
+            if listing is None:
+                return None
+            artifacts+=[{ "id":x["id"], "name":x["name"] } for x in listing["artifacts"] if not x.get("expired")]
+            if len(listing["artifacts"])<GITHUB_PAGE_SIZE or page*GITHUB_PAGE_SIZE>=listing.get("total_count",0):
+                break
+
+        logger.info("Build %s has %s artifacts",lastRun["id"],len(artifacts))
+
+        self._githubCache.setSyncState("nightly", { "run":lastRun["id"], "artifacts":artifacts })
+        return artifacts
+
+    def syncReleases(self):
+
+        # newest first, paging back only as far as the newest release we already knew
+        # the first page is always asked for (a 304 when nothing's changed), it catches edits and late uploaded assets
+        known=self._githubCache.syncState("releases") or { "last":None, "releases":[] }
+
+        fresh=[]
+        for page in range(1, GITHUB_MAX_PAGES+1):
+
+            listing=self.fetchListOfAllReleases(page)
+            if listing is None:
+                if page==1:
+                    return None
+                break
+
+            fresh+=listing
+
+            if len(listing)<GITHUB_PAGE_SIZE:
+                break
+            if known["last"] is not None and any(x["id"]<=known["last"] for x in listing):
+                break
+            # first sync, stop once we've a release to serve
+            if known["last"] is None and any(not x.get("draft") and not x.get("prerelease") for x in fresh):
+                break
+
+        logger.debug("Release sync took %s pages, %s releases",page,len(fresh))
+
+        # what we saw replaces what we knew, anything we knew in that span that's gone was deleted
+        seen=set(x["id"] for x in fresh)
+        oldest=min(seen) if len(seen) else None
+        releases=[_releaseSummary(x) for x in fresh]
+        releases+=[x for x in known["releases"] if x["id"] not in seen and (oldest is None or x["id"]<oldest)]
+        releases.sort(key=lambda x: x["id"], reverse=True)
+        releases=releases[:RELEASES_KEPT]
+
+        self._githubCache.setSyncState("releases", { "last":releases[0]["id"] if len(releases) else None, "releases":releases })
+        return releases
 
     # deprecated
     def fetchReleaseAssets(self, release):
         # build the url
         url="https://api.github.com/repos/{}/{}/releases/{}/assets".format(self._owner,self._repo,release)
 
+        return self.fetchGithubJson(url, "fetchReleaseAssets")
+
+    def githubHeaders(self):
+
+        # authenticated calls get a far bigger quota
+        if self._haconfig.get("token"):
+            return {"Authorization":"token "+self._haconfig["token"]}
+        return {}
+
+    def fetchGithubJson(self, url, caller):
+
+        # unchanged since last time costs a 304 and no parsing
+        headers=self.githubHeaders()
+        headers.update(self._githubCache.conditionalHeaders(url))
+
         # get that as json
-        req=requests.get(url)
-        
+        try:
+            req=self._session.get(url, headers=headers, timeout=GITHUB_TIMEOUT)
+        except requests.RequestException as e:
+            metrics.inc("espupdate_github_requests_total", call=caller, status="error")
+            logger.error("%s : %s failed %s",caller, url, e)
+            return None
+
+        self.measureGithub(caller, req)
+
+        if req.status_code==304:
+            logger.debug("%s : %s unchanged",caller, url)
+            return self._githubCache.cached(url)
+
         if req.status_code==200:
-            return req.json()
+            body=req.json()
+            self._githubCache.store(url, req.headers, body)
+            return body
 
-        logger.error("fetchReleaseAssets : %s returned %s",url, req.status_code)
+        if req.status_code in (403,429) and not self._githubCache.ready():
+            logger.warning("%s : rate limited until %s",caller, time.ctime(self._githubCache.notBefore()))
+            return None
+
+        logger.error("%s : %s returned %s",caller, url, req.status_code)
 
         return None
 
 
-    def downloadReleaseAsset(self, release, asset_dir):
+    def measureGithub(self, caller, req):
+        metrics.inc("espupdate_github_requests_total", call=caller, status=req.status_code)
+        metrics.observe("espupdate_github_request_seconds", req.elapsed.total_seconds(), call=caller)
+        self._githubCache.noteLimits(req.headers)
+
+    def downloadReleaseAsset(self, release, osdir, hashes=None, wanted=None, deferred=None):
+
+        # extracts into osdir, returns the files - or None if any asset didn't make it
+        # hashes, if given, gets (md5, sha256) of each file
+        # only the hardware in wanted is extracted (None for all), deferred gets family -> assets holding the rest
+        files=[]
+
+        # has assets
+        if "assets" in release and len(release["assets"])>0:
+
+            # fetch them side by side, keep the file list in asset order
+            with ThreadPoolExecutor(max_workers=GITHUB_POOL) as pool:
+                for assetFiles in pool.map(lambda x: self._download_release_asset(x, osdir, hashes, wanted, deferred), release["assets"]):
+                    if assetFiles is None:
+                        files=None
+                    elif files is not None:
+                        files+=assetFiles
+
+            logger.debug(files)
+
+        else:
+            logger.error("no assets for '%s'",release["name"])
+
+        return files
+
+    def _download_release_asset(self, eachAsset, osdir, hashes=None, wanted=None, deferred=None):
+
+        files=[]
+        skipped=[]
+
+        url=eachAsset["browser_download_url"]
+
+        try:
+            with self._session.get(url, stream=True, timeout=GITHUB_TIMEOUT) as req:
 
-        osdir=os.path.join(DATA_STEM,asset_dir)
+                self.measureGithub("release_asset", req)
 
-        # always ensure asset_dir is there
-        if not os.path.exists(osdir) or not os.path.isdir(osdir):
-            logger.debug("Creating directory %s", osdir)
-            os.mkdir(osdir)
+                if req.status_code!=200:
+                    logger.error("HTTP error %s",str(req.status_code))
+                    return None
+
+                logger.debug("Extracting %s",eachAsset["name"])
+
+                # detar straight off the wire
+                req.raw.decode_content=True
+
+                with tarfile.open(fileobj=req.raw, mode="r|*") as tf:
+                    _extractMembers(tf, osdir, files, self._haconfig["gzip"], hashes, wanted, skipped)
+
+        except tarfile.TarError as e:
+            logger.error("%s is not a tarfile - %s",eachAsset["name"],e)
+            return None
+        except (requests.RequestException, urllib3.exceptions.HTTPError) as e:
+            # off req.raw, a connection that drops mid body surfaces as urllib3's own errors
+            metrics.inc("espupdate_github_requests_total", call="release_asset", status="error")
+            logger.error("fetching %s failed %s",eachAsset["name"],e)
+            return None
+
+        if deferred is not None:
+            source={ "name":eachAsset["name"], "browser_download_url":url }
+            for family in set(_family(x) for x in skipped):
+                deferred.setdefault(family,[]).append(source)
+
+        return files
+
+    def _download_artifacts(self):
+
+        # firmware artifacts are <hardware>-<tag>, anything else the build uploads isn't ours
+        firmware=[x for x in self._nightly if _artifactTag(x["name"]) is not None]
+
+        if len(firmware):
+            tagName=_artifactTag(firmware[0]["name"])
+
+            current=self._config["manifest"].get("nightly",{})
+            pinned=current.get("pinned",False)
+
+            if pinned and "nightly" in self._damaged:
+                # the pinned build can only be mended while it's still the newest, artifacts don't outlive their build
+                if current["tag_name"]!=tagName:
+                    logger.error("nightly is pinned to %s and damaged, its artifacts are gone - unpin it to recover",current["tag_name"])
+                    return
+            elif pinned:
+                logger.info("nightly is pinned to %s, not following %s",current["tag_name"],tagName)
+                return
+
+            if "nightly" in self._damaged or "nightly" not in self._config["manifest"] or "tag_name" not in self._config["manifest"]["nightly"] or self._config["manifest"]["nightly"]["tag_name"]!=tagName:
+
+                if self._restoreFromHistory("nightly", tagName, pinned):
+                    return
 
-        self._config["manifest"][asset_dir]["tag_name"]=release["tag_name"]
-        self._config["manifest"][asset_dir]["files"]=[]
+                staging=self._stage()
+                try:
+                    Node={ "tag_name":tagName, "files":[] }
+                    if pinned:
+                        Node["pinned"]=True
+                    hashes={}
+
+                    # an artifact per hardware family, only fetch the ones we've a use for
+                    wanted=self.wantedFamilies()
+                    fetch=[x for x in firmware if wanted is None or _family(x["name"]) in wanted]
+                    deferred={}
+                    for each in firmware:
+                        if each not in fetch:
+                            deferred.setdefault(_family(each["name"]),[]).append({ "id":each["id"], "name":each["name"] })
+                    if len(deferred):
+                        Node["deferred"]=deferred
+                        logger.info("nightly %s - not fetching %s until they're wanted",tagName,", ".join(sorted(deferred)))
+
+                    started=time.time()
+
+                    # fetch them side by side, keep the file list in artifact order
+                    with ThreadPoolExecutor(max_workers=GITHUB_POOL) as pool:
+                        for files in pool.map(lambda x: self._download_artifact(x, staging, hashes), fetch):
+                            if files is None:
+                                Node=None
+                            elif Node is not None:
+                                Node["files"]+=files
+
+                    metrics.observe("espupdate_extract_seconds", time.time()-started, channel="nightly")
+
+                    if Node is None:
+                        logger.error("nightly %s incomplete, keeping what we have",tagName)
+                    else:
+                        self._publish("nightly", Node, staging, hashes)
+                finally:
+                    # however it went, nothing else clears staging before a restart
+                    shutil.rmtree(staging, ignore_errors=True)
+
+    def _download_artifact(self, each, osdir, hashes=None):
+
+        files=[]
+
+        # /repos/{owner}/{repo}/actions/artifacts/{artifact_id}/{archive_format}
+        url="https://api.github.com/repos/{}/{}/actions/artifacts/{}/zip".format(self._owner,self._repo,each["id"])
+
+        try:
+            #Authorization: token $PERSONAL_TOKEN
+            with self._session.get(url, headers=self.githubHeaders(), stream=True, timeout=GITHUB_TIMEOUT) as req:
+
+                self.measureGithub("artifact", req)
+
+                if req.status_code!=200:
+                    logger.error("HTTP error %s fetching artifact %s",req.status_code,each["name"])
+                    return None
+
+                # a zip needs its central directory, so it has to land somewhere seekable first
+                with tempfile.SpooledTemporaryFile(max_size=ARTIFACT_SPOOL) as spool:
+
+                    shutil.copyfileobj(req.raw,spool)
+
+                    with zipfile.ZipFile(spool) as unzip:
+                        # should be a tar.gz, detar it straight out of the zip
+                        with unzip.open(unzip.filelist[0]) as inner, tarfile.open(fileobj=inner, mode="r|*") as tf:
+                            _extractMembers(tf, osdir, files, self._haconfig["gzip"], hashes)
+
+        except (zipfile.BadZipFile, tarfile.TarError, IndexError) as e:
+            logger.error("artifact %s is not a zipped tarfile - %s",each["name"],e)
+            return None
+        except (requests.RequestException, urllib3.exceptions.HTTPError) as e:
+            metrics.inc("espupdate_github_requests_total", call="artifact", status="error")
+            logger.error("fetching artifact %s failed %s",each["name"],e)
+            return None
+
+        return files
+
+    def _stage(self):
+        # somewhere private to extract a new set into, nothing serves from here
+        staging=tempfile.mkdtemp(dir=DATA_STEM, prefix=STAGING_PREFIX)
+        logger.debug("Staging into %s",staging)
+        return staging
+
+    def _publish(self, asset_dir, Node, staging, hashes=None):
+
+        # held from ingest to switch, another switch's collect would see our new blobs as garbage
+        with self._publishing:
+
+            self._ingest(Node, staging, hashes)
+
+            shutil.rmtree(staging, ignore_errors=True)
+
+            self._switchChannel(asset_dir, Node)
+
+    def _ingest(self, Node, staging, hashes=None):
+
+        # file the staged set away by content, then it's just a pointer
+        # the md5 goes out as x-MD5, so devices check what they flash
+        # callers hold _publishing until the node referring to them is live
+        Node["blobs"]={}
+        Node["md5"]={}
+        for each in Node["files"]:
+            for name in [each, each+".gz"]:
+                path=os.path.join(staging,name)
+                if os.path.isfile(path):
+                    md5, sha = hashes[name] if hashes is not None and name in hashes else _fileHashes(path)
+                    Node["blobs"][name]=self._blobs.ingest(path, sha)
+                    Node["md5"][name]=md5
+
+    def wantedFamilies(self):
+
+        # None means all of them - we haven't seen a device yet, and nothing's configured
+        with self._familyLock:
+            wanted=self._families|set(self._haconfig["hardware"])
+        return wanted if len(wanted) else None
+
+    def noteFamily(self, family):
+
+        # hardware the fleet runs, so polls extract what's used - and what we skipped gets fetched now
+        with self._familyLock:
+            if family in self._families:
+                return
+
+        # only hardware some release has firmware for, anything a client makes up isn't worth a manifest write
+        if not self.knownFamily(family):
+            return
+
+        with self._familyLock:
+            if family in self._families:
+                return
+            self._families.add(family)
+            families=sorted(self._families)
+
+        logger.info("First sight of %s hardware",family)
+        self._lazy.submit(self._manifest.setValue, "families", families)
+
+        for channel, Node in list(self._config["manifest"].items()):
+            if family in Node.get("deferred",{}):
+                self.fetchDeferred(channel, family)
+
+    def wantFamily(self, family):
+
+        # noted, and anything skipped of it fetched even if it was noted before - an earlier fetch may have failed
+        self.noteFamily(family)
+        for channel, Node in list(self._config["manifest"].items()):
+            if family in Node.get("deferred",{}):
+                self.fetchDeferred(channel, family)
+
+    def knownFamily(self, family):
+        for Node in list(self._config["manifest"].values()):
+            if family in Node.get("deferred",{}) or any(_family(x)==family for x in Node.get("files",[])):
+                return True
+        return False
 
-        # has assets
-        if "assets" in release and len(release["assets"])>0:
-            for eachAsset in release["assets"]:
+    def fetchDeferred(self, channel, family):
 
-                url=eachAsset["browser_download_url"]
+        if self._haconfig["offline"]:
+            return
 
-                with requests.get(url, stream=True) as req:
-        
-                    if req.status_code==200:
+        with self._familyLock:
+            if (channel, family) in self._fetching:
+                return
+            self._fetching.add((channel, family))
 
-                        filename="/tmp/"+eachAsset["name"]
+        # the leader does the fetching, mdns doesn't cross sites so a follower has to tell it what's wanted
+        if self._follower:
+            self._lazy.submit(self._reportFamily_job, channel, family)
+        else:
+            self._lazy.submit(self._fetchDeferred_job, channel, family)
 
-                        logger.debug("Creating file %s",filename)
+    def _reportFamily_job(self, channel, family):
 
-                        with open(filename, 'wb') as fd:
-                            #fd.write(req.content)
-                            shutil.copyfileobj(req.raw, fd)
+        try:
+            with self._session.post(self._leader+"/family", params={ "name":family }, timeout=GITHUB_TIMEOUT) as req:
+                metrics.inc("espupdate_cluster_requests_total", call="family", status=req.status_code)
+                if req.status_code!=200:
+                    logger.error("HTTP error %s telling %s about %s",req.status_code,self._leader,family)
+                else:
+                    logger.info("Asked %s to fetch %s %s",self._leader,channel,family)
+        except requests.RequestException as e:
+            metrics.inc("espupdate_cluster_requests_total", call="family", status="error")
+            logger.error("telling %s about %s failed %s",self._leader,family,e)
 
-                        # check it
-                        if tarfile.is_tarfile(filename):
+        finally:
+            with self._familyLock:
+                self._fetching.discard((channel, family))
 
-                            # detar into pd
-                            tf=tarfile.open(filename)
+    def _fetchDeferred_job(self, channel, family):
 
-                            tf.extractall(osdir)
+        staging=None
+        try:
+            Node=self._config["manifest"].get(channel,{})
+            sources=Node.get("deferred",{}).get(family)
+            if not sources:
+                return
 
-                            for member in tf.getmembers():
-                                self._config["manifest"][asset_dir]["files"].append(member.name)
+            logger.info("Fetching %s %s for %s",channel,Node["tag_name"],family)
 
-                            logger.debug("Deleting file %s",filename)
-                            os.remove(filename)
+            staging=self._stage()
+            hashes={}
+            extra={ "files":[] }
 
-                            logger.debug(self._config["manifest"][asset_dir])
+            for source in sources:
+                if "browser_download_url" in source:
+                    files=self._download_release_asset(source, staging, hashes, {family})
+                else:
+                    files=self._download_artifact(source, staging, hashes)
+                if files is None:
+                    logger.error("%s %s for %s incomplete, will try again when it's next wanted",channel,Node["tag_name"],family)
+                    return
+                extra["files"]+=files
 
+            with self._publishing:
 
-                        else:
-                            logger.error("%s is not a tarfile",filename)
-                    else:
-                        logger.error("HTTP error %s",str(req.status_code))
-                    
-        else:
-            logger.error("no assets for %s '%s'",asset_dir, release["name"])
+                self._ingest(extra, staging, hashes)
+                shutil.rmtree(staging, ignore_errors=True)
 
-    def _download_artifacts(self):
+                # folded into whatever is live, as long as it's still the same tag
+                current=self._config["manifest"].get(channel,{})
+                if current.get("tag_name")!=Node["tag_name"]:
+                    logger.info("%s moved on from %s, dropping %s",channel,Node["tag_name"],family)
+                    return
 
-        osdir=os.path.join(DATA_STEM,"nightly")
-        if not os.path.exists(osdir) or not os.path.isdir(osdir):
-            logger.debug("Creating directory %s", osdir)
-            os.mkdir(osdir)
+                merged=dict(current)
+                merged["files"]=current["files"]+[x for x in extra["files"] if x not in current["files"]]
+                merged["blobs"]=dict(current.get("blobs",{}), **extra["blobs"])
+                merged["md5"]=dict(current.get("md5",{}), **extra["md5"])
+                merged["deferred"]={ k:v for k,v in current.get("deferred",{}).items() if k!=family }
+                if len(merged["deferred"])==0:
+                    del merged["deferred"]
 
+                self._switchChannel(channel, merged)
 
-        if len(self._nightly):
-            tagName=self._nightly[0]["name"].split("-")[1]
+        except Exception as e:
+            logger.error("Fetching %s %s failed %s",channel,family,e)
+
+        finally:
+            if staging is not None:
+                shutil.rmtree(staging, ignore_errors=True)
+            with self._familyLock:
+                self._fetching.discard((channel, family))
+
+    def _switchChannel(self, asset_dir, Node):
+
+        with self._publishing:
+
+            previous=self._config["manifest"].get(asset_dir)
+            history, keep = self._retainHistory(asset_dir, Node)
+
+            # the pointer flip, requests see the old set or the new one, never a mix
+            self.saveChannel(asset_dir, Node, history)
+            self._damaged.discard(asset_dir)
+
+            logger.info("Published %s %s",asset_dir,Node["tag_name"])
+
+            self._changes.publish("channel", channel=asset_dir, tag=Node["tag_name"], previous=previous.get("tag_name") if previous is not None else None)
+
+            # a set from before the blob store goes, blobs go once nothing (live or history) wants them
+            if previous is not None and "blobs" not in previous:
+                self._clean_up(asset_dir, previous)
+            self._blobs.collect(keep)
+
+        # shits changed yo, worth an update loop
+        self.manifestChanged()
+
+    def _retainHistory(self, asset_dir, Node):
+
+        # the history once Node is live, trimmed to history_mb - and every blob that's still wanted
+        live=dict(self._config["manifest"])
+        previous=live.get(asset_dir)
+        live[asset_dir]=Node
+
+        history={ channel:[x for x in nodes if x["tag_name"]!=Node["tag_name"] or channel!=asset_dir] for channel, nodes in self._config["history"].items() }
+        if previous is not None and "blobs" in previous and previous["tag_name"]!=Node["tag_name"]:
+            history[asset_dir]=[previous]+history.get(asset_dir,[])
+
+        keep=set()
+        for each in live.values():
+            keep.update(each.get("blobs",{}).values())
+
+        # newest first across all the channels, until the budget's spent
+        budget=self._haconfig["history_mb"]*1024*1024
+        trimmed={ channel:[] for channel in history }
+        for depth in range(max([len(x) for x in history.values()]+[0])):
+            for channel, nodes in history.items():
+                if depth>=len(nodes):
+                    continue
+                wanted=set(nodes[depth]["blobs"].values())-keep
+                if not all(self._blobs.has(x) for x in wanted):
+                    continue
+                cost=sum(self._blobs.size(x) for x in wanted)
+                if cost>budget:
+                    continue
+                budget-=cost
+                keep|=wanted
+                trimmed[channel].append(nodes[depth])
+
+        return trimmed, keep
+
+    def _restoreFromHistory(self, asset_dir, tagName, pinned=False):
+
+        # a tag we've had before and still hold every blob of needs no download
+        for old in self._config["history"].get(asset_dir,[]):
+            if old["tag_name"]==tagName and all(self._blobs.verify(x) for x in set(old["blobs"].values())):
+                Node=dict(old)
+                Node.pop("pinned",None)
+                if pinned:
+                    Node["pinned"]=True
+                logger.info("%s %s restored from history",asset_dir,tagName)
+                self._switchChannel(asset_dir, Node)
+                return True
+        return False
 
-            if "nightly" not in self._config["manifest"] or "tag_name" not in self._config["manifest"]["nightly"] or self._config["manifest"]["nightly"]["tag_name"]!=tagName:
+    def _clean_up(self, asset_dir, Node):
 
-                self._clean_up("nightly")
+        folder=Node.get("dir",asset_dir)
 
-                self._config["manifest"]["nightly"]={}
-                self._config["manifest"]["nightly"]["files"]=[]
+        if folder!=asset_dir:
+            logger.info("removing %s",folder)
+            shutil.rmtree(os.path.join(DATA_STEM,folder), ignore_errors=True)
+            # and the /data/<channel> link that pointed at it
+            link=os.path.join(DATA_STEM,asset_dir)
+            if os.path.islink(link):
+                os.remove(link)
+            return
 
-                self._config["manifest"]["nightly"]["tag_name"]=tagName
+        # from before sets were staged, files straight in /data/<channel>
+        if "files" in Node:
+            for eachFile in Node["files"]:
+                logger.info("removing %s",eachFile)
+                filetokill=DATA_STEM+"/"+asset_dir+"/"+eachFile
+                self._cache.evict(filetokill)
+                if os.path.exists(filetokill):
+                    os.remove(filetokill)
 
+        try:
+            os.rmdir(os.path.join(DATA_STEM,asset_dir))
+        except OSError as e:
+            logger.warning("couldn't remove %s - %s",asset_dir,e)
 
-                for each in self._nightly:
+    def _verifyManifest(self):
 
-                    # /repos/{owner}/{repo}/actions/artifacts/{artifact_id}/{archive_format}
-                    url="https://api.github.com/repos/{}/{}/actions/artifacts/{}/zip".format(self._owner,self._repo,each["id"])
+        # channels with missing or damaged files are fetched again, whatever their tag
+        self._damaged=set()
 
-                    #Authorization: token $PERSONAL_TOKEN
-                    req=requests.get(url, headers={"Authorization":"token "+self._haconfig["token"]}, stream=True)
+        started=time.time()
+        verified={}
 
-                    if req.status_code==200:
+        for channel, Node in self._config["manifest"].items():
 
-                        with open("/tmp/tmp.zip","wb") as zip:
-                            shutil.copyfileobj(req.raw,zip)
-                            zip.close()
+            if "blobs" in Node:
+                for name, digest in Node["blobs"].items():
+                    if digest not in verified:
+                        verified[digest]=self._blobs.verify(digest, Node.get("md5",{}).get(name))
+                bad=[name for name, digest in Node["blobs"].items() if not verified[digest]]
+            else:
+                # a set from before the blob store, all we can check is that it's there
+                folder=os.path.join(DATA_STEM,Node.get("dir",channel))
+                bad=[name for name in Node.get("files",[]) if not os.path.isfile(os.path.join(folder,name))]
 
-                            if zipfile.is_zipfile("/tmp/tmp.zip"):
-                                with zipfile.ZipFile("/tmp/tmp.zip") as unzip:
-                                    unzip.extractall(osdir)
+            if len(bad):
+                logger.error("%s %s is damaged (%s), it'll be fetched again",channel,Node.get("tag_name"),", ".join(bad))
+                self._damaged.add(channel)
 
-                                tarname=os.path.join(osdir,unzip.filelist[0].filename)
+        # the index was built before we knew, take out what's gone
+        if len(self._damaged):
+            self.buildFirmwareIndex()
 
-                                # should be a tar.gz
-                                tf=tarfile.open(tarname)
-                                tf.extractall(osdir)
-                                for member in tf.getmembers():
-                                    self._config["manifest"]["nightly"]["files"].append(member.name)
-                                tf.close()
-                                os.unlink(tarname)
+        logger.info("Verified %s files in %.1fs, %s channels to fetch again",len(verified),time.time()-started,len(self._damaged))
 
+    def _tidy_staging(self):
 
-                            os.unlink("/tmp/tmp.zip")
-                self.saveConfig()
+        # a crash can leave a half extracted set, or one that never got published
+        live=set(Node.get("dir") for Node in self._config["manifest"].values())
 
-    def _clean_up(self, asset_dir):
+        for each in os.listdir(DATA_STEM):
+            published=any(each.startswith(x+"-") for x in ("releases","nightly"))
+            if each.startswith(STAGING_PREFIX) or (published and each not in live):
+                path=os.path.join(DATA_STEM,each)
+                if os.path.isdir(path) and not os.path.islink(path):
+                    logger.info("removing orphaned %s",each)
+                    shutil.rmtree(path, ignore_errors=True)
 
-        if asset_dir in self._config["manifest"] and "files" in self._config["manifest"][asset_dir]:
-            for eachFile in self._config["manifest"][asset_dir]["files"]:
-                logger.info("removing %s",eachFile)
-                filetokill=DATA_STEM+"/"+asset_dir+"/"+eachFile
-                if os.path.exists(filetokill):
-                    os.remove(filetokill)
+        # and blobs nothing refers to
+        keep=set()
+        for Node in list(self._config["manifest"].values())+[x for nodes in self._config["history"].values() for x in nodes]:
+            keep.update(Node.get("blobs",{}).values())
+        self._blobs.collect(keep)
 
 
     def _download_asset(self, asset_list, asset_dir):
@@ -341,24 +1829,50 @@ class RepoReleases:
 
             topRelease=asset_list[0]
 
+            current=self._config["manifest"].get(asset_dir,{})
+            pinned=current.get("pinned",False)
+
+            if pinned and asset_dir in self._damaged:
+                # mend the pinned tag, not the newest
+                release=self.fetchReleaseByTag(current["tag_name"])
+                if release is None:
+                    logger.error("%s is pinned to %s and damaged, but github can't give us %s",asset_dir,current["tag_name"],current["tag_name"])
+                    return
+                topRelease=_releaseSummary(release)
+            elif pinned:
+                logger.info("%s is pinned to %s, not following %s",asset_dir,current["tag_name"],topRelease["tag_name"])
+                return
+
             # check we haven't already got this
-            if asset_dir not in self._config["manifest"] or "tag_name" not in self._config["manifest"][asset_dir] or topRelease["tag_name"] != self._config["manifest"][asset_dir]["tag_name"]:
+            if asset_dir in self._damaged or asset_dir not in self._config["manifest"] or "tag_name" not in self._config["manifest"][asset_dir] or topRelease["tag_name"] != self._config["manifest"][asset_dir]["tag_name"]:
 
                 #sanity check the tag
-                if self.crackVersion(topRelease["tag_name"]) is None:
+                if Version.parse(topRelease["tag_name"]) is None:
                     logger.error("version is malformed %s",topRelease["tag_name"])
+                elif self._restoreFromHistory(asset_dir, topRelease["tag_name"], pinned):
+                    pass
                 else:
-                    # we should clean up
-                    self._clean_up(asset_dir)
-
-                    self._config["manifest"][asset_dir]={}
-
-                    self.downloadReleaseAsset(topRelease,asset_dir)
-
-                    self.saveConfig()
-
-                    # shits changed yo, worth an update loop
-                    self._updatePending=True
+                    # build the new set beside the old one, which carries on serving
+                    staging=self._stage()
+                    try:
+                        started=time.time()
+                        hashes={}
+                        deferred={}
+                        files=self.downloadReleaseAsset(topRelease,staging,hashes,self.wantedFamilies(),deferred)
+                        metrics.observe("espupdate_extract_seconds", time.time()-started, channel=asset_dir)
+
+                        if files is None:
+                            logger.error("%s %s incomplete, keeping what we have",asset_dir,topRelease["tag_name"])
+                        else:
+                            Node={ "tag_name":topRelease["tag_name"], "files":files }
+                            if pinned:
+                                Node["pinned"]=True
+                            if len(deferred):
+                                Node["deferred"]=deferred
+                                logger.info("%s %s - not extracting %s until they're wanted",asset_dir,topRelease["tag_name"],", ".join(sorted(deferred)))
+                            self._publish(asset_dir, Node, staging, hashes)
+                    finally:
+                        shutil.rmtree(staging, ignore_errors=True)
 
             else:
                 logger.info("%s %s assets already downloaded",asset_dir, topRelease["tag_name"])
@@ -370,8 +1884,24 @@ class RepoReleases:
 
     def downloadLatestAssets(self):
 
+        if self._haconfig["offline"]:
+            logger.debug("Offline, not polling github")
+            return
+
+        if self._follower:
+            self._mirrorLeader()
+            return
+
+        if not self._githubCache.ready():
+            logger.warning("Github wants us to back off until %s, keeping what we have",time.ctime(self._githubCache.notBefore()))
+            return
+
         # do a gather
+        started=time.time()
         self.gather()
+        metrics.observe("espupdate_gather_seconds", time.time()-started)
+
+        self._githubCache.save()
 
         # work out the newest release, and prerelease
         if self._haconfig["release"]==True:
@@ -381,77 +1911,181 @@ class RepoReleases:
             self._download_artifacts()
 
 
+    def _mirrorLeader(self):
+
+        # take the leader's manifest, fetching only the blobs we don't already hold
+        try:
+            with self._session.get(self._leader+"/manifest", timeout=GITHUB_TIMEOUT) as req:
+                metrics.inc("espupdate_cluster_requests_total", call="manifest", status=req.status_code)
+                if req.status_code!=200:
+                    logger.error("HTTP error %s fetching the manifest from %s",req.status_code,self._leader)
+                    return
+                theirs=req.json()
+        except (requests.RequestException, ValueError) as e:
+            metrics.inc("espupdate_cluster_requests_total", call="manifest", status="error")
+            logger.error("fetching the manifest from %s failed %s",self._leader,e)
+            return
+
+        for channel, Node in theirs.get("manifest",{}).items():
+
+            if "blobs" not in Node:
+                logger.warning("leader's %s predates the blob store, can't mirror it",channel)
+                continue
+
+            ours=self._config["manifest"].get(channel,{})
+            if channel not in self._damaged and all(ours.get(x)==Node.get(x) for x in ("tag_name","blobs","pinned")):
+                continue
+
+            wanted=[x for x in set(Node["blobs"].values()) if not self._blobs.has(x)]
+            staging=self._stage()
+            try:
+                with ThreadPoolExecutor(max_workers=GITHUB_POOL) as pool:
+                    fetched=list(pool.map(lambda x: self._fetchBlob(x, staging), wanted))
+
+                # into the store and live under one hold of _publishing, so no collect runs in between
+                with self._publishing:
+                    if all(fetched):
+                        for digest in wanted:
+                            self._blobs.ingest(os.path.join(staging,digest), digest)
+                    # what we already held may have been collected while we were fetching
+                    if all(fetched) and all(self._blobs.has(x) for x in Node["blobs"].values()):
+                        self._switchChannel(channel, Node)
+                    else:
+                        logger.error("%s %s incomplete from %s, keeping what we have",channel,Node.get("tag_name"),self._leader)
+            finally:
+                shutil.rmtree(staging, ignore_errors=True)
+
+    def _fetchBlob(self, digest, staging):
+
+        path=os.path.join(staging,digest)
+
+        try:
+            with self._session.get("{}/blobs/{}".format(self._leader,digest), stream=True, timeout=GITHUB_TIMEOUT) as req:
+                metrics.inc("espupdate_cluster_requests_total", call="blob", status=req.status_code)
+                if req.status_code!=200:
+                    logger.error("HTTP error %s fetching blob %s",req.status_code,digest)
+                    return False
+                with open(path,"wb") as out:
+                    shutil.copyfileobj(req.raw,out)
+        except (requests.RequestException, urllib3.exceptions.HTTPError, OSError) as e:
+            metrics.inc("espupdate_cluster_requests_total", call="blob", status="error")
+            logger.error("fetching blob %s failed %s",digest,e)
+            return False
+
+        # checked against its name before it goes near the store, a damaged copy can't pass for the real thing
+        if _fileDigest(path)!=digest:
+            logger.error("blob %s arrived damaged",digest)
+            return False
+
+        return True
+
+    def manifestChanged(self):
+        # worth an update loop, and don't wait for the next poll to do it
+        self._updatePending=True
+        self._wake.set()
+
     def stopPoller(self):
 
-        if self._fetch_running==True:
+        logger.debug("requesting poll stop ...")
+        self._stop.set()
+        self._wake.set()
 
-            logger.debug("requesting poll stop ...")
-            self._stop=True
+        # let anyone following /changes go
+        self._changes.close()
 
-            while self._fetch_running and self._zeroRunninng:
-                pass
+        self._lazy.shutdown(wait=False, cancel_futures=True)
 
-            logger.debug("poll stopped!")
+        # bounded, a thread stuck on the network is a daemon and won't hold up exit
+        self._rollout.stop(SHUTDOWN_TIMEOUT)
 
+        for thread in [self._poller, self._zero_conf]+([self._cluster] if self._follower else []):
+            if thread.is_alive() and thread is not threading.current_thread():
+                thread.join(SHUTDOWN_TIMEOUT)
+                if thread.is_alive():
+                    logger.warning("%s didn't stop in %ss",thread.name,SHUTDOWN_TIMEOUT)
 
-    def update_service(self, zeroconf, service_type, name):
-        # it's possible the version has changed, catch that
-        self.add_service(zeroconf, service_type, name)
+        logger.debug("poll stopped!")
 
-    def remove_service(self, zeroconf, service_type, name):
-        logger.info("Service %s removed",name)
-        info = zeroconf.get_service_info(service_type, name)
 
-        def delMDNShost(hosts,name, info):
+    def on_service_state_change(self, zeroconf, service_type, name, state_change):
 
-            for each in hosts:
-                if each["name"]==name:
-                    hosts.remove(each)
-                    return
+        # runs on the discovery event loop, so mustn't block
 
+        if state_change is ServiceStateChange.Removed:
+            # it's gone, there's nothing to ask it
+            logger.info("Service %s removed",name)
+            task=self._resolves.pop(name,None)
+            if task is not None:
+                task.cancel()
+            self._stale.discard(name)
+            self._devices.remove(name)
+            return
 
-        delMDNShost(self._mdnshosts,name, info)
-        
+        # added or updated - it's possible the version has changed, catch that
+        if name in self._resolves:
+            # a burst of announcements for one device resolves once
+            if name not in self._debouncing:
+                self._stale.add(name)
+            return
 
-    def add_service(self, zeroconf, service_type, name):
-        info = zeroconf.get_service_info(service_type, name)
-        logger.debug("Service %s add_service info %s",name, info)
+        self._resolves[name]=asyncio.ensure_future(self._resolve(zeroconf, service_type, name))
 
+    async def _resolve(self, zeroconf, service_type, name):
 
-        def addMDNShost(hosts, name, info):
-            alreadyThere=[x for x in hosts if x["server"] == info.server]
+        try:
+            while True:
 
-            # work out string address
-            address=info.addresses[0]
-            stringAddress="{}.{}.{}.{}".format(address[0], address[1], address[2],address[3])
-            logger.debug("%s ip %s",info.server,stringAddress)
-            hostversion=None
-            if b"version" in info.properties:
-                hostversion=info.properties[b"version"].decode("UTF8")
+                self._debouncing.add(name)
+                await asyncio.sleep(MDNS_DEBOUNCE)
+                self._debouncing.discard(name)
 
-            if len(alreadyThere)!=0:
-                logger.info("updating Service %s add_service info %s",name, info)
-                alreadyThere[0]["address"]=stringAddress
-                if hostversion is not None:
-                    alreadyThere[0]["version"]=hostversion
-            else:
-                logger.info("adding Service %s add_service info %s",name, info)
-                newhost={"name":name, "server":info.server,"address": stringAddress}
-                # check for version in properties - props is utf8, so decode
-                if b"version" in info.properties:
-                    newhost["version"]=info.properties[b"version"].decode("UTF8")
-                logger.debug(newhost)
-                hosts.append(newhost)
+                async with self._resolving:
+                    info=AsyncServiceInfo(service_type, name)
+                    found=await info.async_request(zeroconf, MDNS_RESOLVE_TIMEOUT)
+
+                if found:
+                    self.add_service_info(name, info)
+                else:
+                    logger.warning("Service %s didn't resolve",name)
+
+                # it re-announced while we were asking, ask again
+                if name not in self._stale:
+                    break
+                self._stale.discard(name)
+
+        finally:
+            self._debouncing.discard(name)
+            if self._resolves.get(name) is asyncio.current_task():
+                del self._resolves[name]
 
+    def add_service_info(self, name, info):
 
+        logger.debug("Service %s add_service info %s",name, info)
+
+        # look for legacy
+        if info.type!=MDNS_SERVICE or len(info.addresses)==0:
+            return
+
+        # work out string address
+        address=info.addresses[0]
+        stringAddress="{}.{}.{}.{}".format(address[0], address[1], address[2],address[3])
+        logger.debug("%s ip %s",info.server,stringAddress)
 
-        # carve up the addresses
-        if info is not None:
+        # check for version in properties - props is utf8, so decode
+        hostversion=None
+        if b"version" in info.properties:
+            hostversion=info.properties[b"version"].decode("UTF8")
+        mac=None
+        if b"mac" in info.properties:
+            mac=info.properties[b"mac"].decode("UTF8")
 
-            # look for legacy
-            if info.type=="_barneyman._tcp.local.":
-                addMDNShost(self._mdnshosts,name, info)
+        if hostversion is not None and hostversion.find("|")>0:
+            self.noteFamily(hostversion.split("|")[0])
 
+        if self._devices.upsert(name, info.server, stringAddress, hostversion, mac):
+            logger.info("adding Service %s add_service info %s",name, info)
+        else:
+            logger.info("updating Service %s add_service info %s",name, info)
 
 
     # threaded functions
@@ -459,170 +2093,245 @@ class RepoReleases:
 
         logger.critical("findDevices_thread started ...")
 
-        zeroconf = Zeroconf()
-        self._zeroRunninng=True
-
-        browser = ServiceBrowser(zeroconf, "_barneyman._tcp.local.", self)
-        
-        while not self._stop:
-            time.sleep(2)
-            pass
+        asyncio.run(self._discover())
 
-        zeroconf.close()
         logger.critical("findDevices_thread stopped ...")
 
-        self._zeroRunninng=False
+    async def _discover(self):
+
+        # name -> the task resolving it, and where each of those tasks is at
+        self._resolves={}
+        self._debouncing=set()
+        self._stale=set()
+        self._resolving=asyncio.Semaphore(MDNS_RESOLVE_CONCURRENCY)
+
+        aiozc=AsyncZeroconf(ip_version=IPVersion.V4Only)
+
+        browser=AsyncServiceBrowser(aiozc.zeroconf, [MDNS_SERVICE], handlers=[self.on_service_state_change])
+
+        # park a worker thread on the stop event, the loop stays free for zeroconf
+        await asyncio.get_running_loop().run_in_executor(None, self._stop.wait)
+
+        for task in list(self._resolves.values()):
+            task.cancel()
+
+        await browser.async_cancel()
+        await aiozc.async_close()
 
     def fetchAssetsTimed_thread(self):
 
         logger.critical("fetchAssetsTimed_thread started ...")
 
-        self._fetch_running=True
-
         self._lastPoll=None
 
-        while not self._stop:
+        while not self._stop.is_set():
 
-            if self._updatePending or (self._lastPoll is None or ((time.time()-self._lastPoll)>self._haconfig["poll"]*60)):
+            # anything that wants us after this point will wake the wait below
+            self._wake.clear()
 
-                logger.debug("Doing a download/upgrade poll")
+            # the poll interval, stretched if github says we're running out of quota
+            due=self._lastPoll is None or time.time()>=self._githubCache.nextPoll(self._lastPoll, self._haconfig["poll"]*60)
 
-                self._polling=True
+            if self._updatePending or due:
 
-                self.downloadLatestAssets()
+                logger.debug("Doing a download/upgrade poll")
 
-                self._polling=False
+                # one bad poll mustn't take the poller with it
+                try:
+                    self.downloadLatestAssets()
+                except Exception as e:
+                    logger.error("Poll failed %s",e)
 
                 self._lastPoll=time.time()
 
                 # then ask all devices to upgrade
-                self.upgradeAllDevices()
+                try:
+                    self.upgradeAllDevices()
+                except Exception as e:
+                    logger.error("Upgrade request failed %s",e)
                 
                 self._updatePending=False
 
-            time.sleep(3)
+            # idle until the next poll is due, or upgradeAll / a new manifest / stopPoller wakes us
+            if not self._updatePending:
+                self._wake.wait(max(0,self._githubCache.nextPoll(self._lastPoll, self._haconfig["poll"]*60)-time.time()))
 
         logger.critical("fetchAssetsTimed_thread stoped")
-        self._fetch_running=False
 
-    def upgradeAllDevices(self):
+    def followLeader_thread(self):
 
-        logger.info("calling upgradeAllDevices with %s devices",len(self._mdnshosts))
-        
-        # we are updating them, they sign off from mdns so this list traversal is broken
-        new_list = [i for i in self._mdnshosts]
+        # long poll the leader's /changes, so a new tag there is mirrored here straight away
+        logger.critical("followLeader_thread started ...")
 
-        for host in new_list:
+        seq=None
+        while not self._stop.is_set():
+            try:
+                params={ "since":seq } if seq is not None else {}
+                with self._session.get(self._leader+"/changes", params=params, timeout=(GITHUB_TIMEOUT[0],CHANGES_LONG_POLL+GITHUB_TIMEOUT[0])) as req:
+                    if req.status_code!=200:
+                        raise requests.RequestException("HTTP error {}".format(req.status_code))
+                    batch=req.json()
+            except (requests.RequestException, ValueError) as e:
+                logger.warning("following %s failed %s",self._leader,e)
+                self._stop.wait(CHANGES_LONG_POLL)
+                continue
 
-            # if host["name"].find("8766C0")==-1:
-            #     continue
+            # a resync means we missed some, or the leader restarted - mirror to be sure
+            if seq is not None and (batch.get("resync") or any(x["type"]=="channel" for x in batch.get("changes",[]))):
+                self.manifestChanged()
+            seq=batch["seq"]
 
-            # quick optimisation, if there is a version, crack it early
-            if "version" in host:
-                hardware = host["version"].split("|")
-                deviceVersion=self.crackVersion(hardware[1])
+        logger.critical("followLeader_thread stopped")
 
-                doupdate=True
-                # doupdate=False
+    def ownsDevice(self, host):
 
-                # if self._haconfig["prerelease"] and deviceVersion["prerelease"]:
-                #     # check the top prerelease
-                #     toppre=self.crackVersion( self._prereleases[0]["tag_name"])
-                #     doupdate=self.vgreater(deviceVersion,toppre)
-                #     logger.debug("mdns ver %s prerel %s result %s",deviceVersion,toppre,doupdate)
+        # standalone we upgrade everything, in a cluster the ring decides between the nodes that can see the device
+        # so one only our site sees is ours - keyed on the service name, a mac may only be known where the device last fetched
+        if self._leader is None:
+            return True
+        me=self._haconfig["cluster_self"]
+        among=set([me])|set(node for node, seen in self._peerDevices.items() if host["name"] in seen)
+        return self._ring.owner(host["name"], among)==me
 
-                # if not doupdate:
-                #     toprel=self.crackVersion( self._releases[0]["tag_name"])
-                #     doupdate=self.vgreater(deviceVersion,toprel)
-                #     logger.debug("mdns ver %s rel %s result %s",deviceVersion,toprel,doupdate)
+    def refreshPeers(self):
 
-                # if not doupdate:
-                #     logger.debug("optimised out an update for %s",host["address"])
-                #     continue
+        # what the other nodes can see, a node we can't reach sees nothing and its share falls to the rest
+        peers=[x for x in self._haconfig["cluster_nodes"] if x!=self._haconfig["cluster_self"]]
 
+        def seen(node):
+            try:
+                with self._session.get(node.rstrip("/")+"/cluster", timeout=GITHUB_TIMEOUT) as req:
+                    metrics.inc("espupdate_cluster_requests_total", call="cluster", status=req.status_code)
+                    if req.status_code==200:
+                        return set(req.json().get("seen",[]))
+                    logger.warning("HTTP error %s asking %s what it sees",req.status_code,node)
+            except (requests.RequestException, ValueError) as e:
+                metrics.inc("espupdate_cluster_requests_total", call="cluster", status="error")
+                logger.warning("asking %s what it sees failed %s",node,e)
+            return set()
 
-            upgradeUrl="http://{}/json/upgrade".format(host["address"])
+        with ThreadPoolExecutor(max_workers=max(1,len(peers))) as pool:
+            self._peerDevices=dict(zip(peers, pool.map(seen, peers)))
 
-            # while running as an HA addon there's a config at /data/options.json
-            # which is populated from options in config.json
+    def upgradeAllDevices(self):
 
-            myIP=myrels._haconfig["host"]
-            myPort=cherrypy.server.socket_port
+        logger.info("calling upgradeAllDevices with %s devices",len(self._devices))
 
-            body={"url":"http://{}:{}/updateBinary".format(myIP,myPort),"urlSpiffs":"http://{}:{}/updateSpiffs".format(myIP,myPort)}
+        # runs on its own thread, so the poller carries on
+        self._rollout.request()
 
-            body=json.dumps(body)
+    def rolloutHosts(self):
 
-            logger.info("Asking %s to update itself",host["address"]) 
-            logger.debug("calling %s with %s",upgradeUrl, body)
+        # we are updating them, they sign off from mdns - so work on a copy
+        new_list = self._devices.snapshot()
 
+        if self._leader is not None:
+            self.refreshPeers()
 
-            try:
-                # Content-Type: text/plain 
-                req=requests.post(upgradeUrl, body, headers={'Content-Type':'text/plain'})
+        # devices only get noted when they fetch, one resolved before the first poll - or current since - never was
+        # so its hardware stays deferred, and isn't offered - fetch it now, the rollout after it lands picks them up
+        for family in set(x["version"].split("|")[0] for x in new_list if len(x.get("version","").split("|"))==2):
+            self.wantFamily(family)
 
-                if req.status_code==200:
-                    # stop us getting bombarded
-                    time.sleep(10)
-                else:
-                    logger.error("Response to UpgradeYourself was %s - Upgrade Only When Off, or refusing pre-rels?",req.status_code)
+        # work out what we're offering once, not once per device
+        offers=self.manifestOffers()
 
+        hosts=[]
+        for host in new_list:
+            if not self.ownsDevice(host):
+                continue
+            if "version" in host and not self.deviceNeedsUpgrade(host["version"], offers):
+                logger.debug("optimised out an update for %s",host["address"])
+                continue
+            hosts.append(host)
 
+        logger.info("%s of %s devices have an upgrade available",len(hosts),len(new_list))
 
-            except Exception as e:
-                logger.error(e)
-            
+        return hosts
 
+    def manifestOffers(self):
 
-    def vgreater(self, earlier, later):
+        # channel -> (cracked tag, hardware families with a binary)
+        offers={}
+        firmware, tags = self._served
+        for channel, tag in tags.items():
+            if tag is not None:
+                offers[channel]=(tag, set())
 
-        # major
-        if earlier["version"][0] > later["version"][0]:
+        for (channel, hardware, kind), entry in firmware.items():
+            if kind=="bin" and entry is not None and channel in offers:
+                offers[channel][1].add(hardware)
+
+        return offers
+
+    def deviceChannel(self, version):
+
+        # devices don't announce their channel, but nightly builds carry it in their version
+        if not self._haconfig["nightly"]:
+            return "releases"
+
+        nightly=self._config["manifest"].get("nightly",{})
+        if version.find("nightly")!=-1 or version==nightly.get("tag_name"):
+            return "nightly"
+
+        return "releases"
+
+    def deviceNeedsUpgrade(self, hostVersion, offers):
+
+        hardware = hostVersion.split("|")
+        if len(hardware)!=2:
+            # sendUpdateFile would refuse it anyway
+            logger.warning("malformed mdns hardware|version %s",hostVersion)
             return False
-        elif earlier["version"][0] < later["version"][0]:
-            return True
 
-        #major is same
-        #minor
-        if earlier["version"][1] > later["version"][1]:
+        deviceVersion=Version.parse(hardware[1])
+        if deviceVersion is None:
+            logger.warning("malformed mdns version %s",hostVersion)
             return False
-        elif earlier["version"][1] < later["version"][1]:
-            return True
 
-        #minor is same
-        #build
-        if earlier["version"][2] > later["version"][2]:
+        channel=self.deviceChannel(hardware[1])
+        if channel not in offers:
             return False
 
-        # debug
-        elif earlier["version"][2] < later["version"][2]:
-            return True
+        tag, families = offers[channel]
 
-        return False
-        
+        return hardware[0] in families and deviceVersion<tag
 
+    def upgradeDevice(self, host):
 
-    def crackVersion(self,vstring):
+        upgradeUrl="http://{}/json/upgrade".format(host["address"])
 
-        # (v\d+\.\d+\.\d+)[\.-]*.*
-        versions=re.match("(v\\d+\\.\\d+\\.\\d+)[\\.-]*(.*)", vstring)
+        # while running as an HA addon there's a config at /data/options.json
+        # which is populated from options in config.json
 
-        if versions is None:
-            return None
+        myIP=self._haconfig["host"]
+        myPort=cherrypy.server.socket_port
 
-        if len(versions.group())!=len(vstring):
-            return None
+        body={"url":"http://{}:{}/updateBinary".format(myIP,myPort),"urlSpiffs":"http://{}:{}/updateSpiffs".format(myIP,myPort)}
+
+        body=json.dumps(body)
 
-        # then crack the number
-        cracked=re.match("v(\\d+)\\.(\\d+)\\.(\\d+)", vstring)
+        logger.info("Asking %s to update itself",host["address"]) 
+        logger.debug("calling %s with %s",upgradeUrl, body)
 
-        ret={ "version": [ int(cracked.group(1)),int(cracked.group(2)),int(cracked.group(3)) ] }
+        try:
+            # Content-Type: text/plain 
+            req=requests.post(upgradeUrl, body, headers={'Content-Type':'text/plain'}, timeout=10)
 
-        logger.debug("Cracked %s to %s",vstring, ret)
+            if req.status_code==200:
+                metrics.inc("espupdate_device_upgrades_total", outcome="accepted")
+                return True
+
+            metrics.inc("espupdate_device_upgrades_total", outcome="refused")
+            logger.error("Response to UpgradeYourself was %s - Upgrade Only When Off, or refusing pre-rels?",req.status_code)
+
+        except Exception as e:
+            metrics.inc("espupdate_device_upgrades_total", outcome="unreachable")
+            logger.error(e)
+
+        return False
 
-        return ret
 
-            
     # web methods
     @cherrypy.expose
     def version(self):
@@ -630,23 +2339,172 @@ class RepoReleases:
 
     @cherrypy.expose
     def manifest(self):
-        return json.dumps(self._config, indent=4)    
+        return self._manifest.render()
 
     @cherrypy.expose
     def hosts(self):
-        return json.dumps(self._mdnshosts, indent=4)    
+        # only re-serialised when the registry has changed
+        generation=self._devices.generation()
+        cached=self._hostsRendered
+        if cached is None or cached[0]!=generation:
+            cached=self._hostsRendered=(generation, json.dumps(self._devices.snapshot(), indent=4))
+        return cached[1]
+
+    @cherrypy.expose
+    def changes(self, since=None, **params):
+
+        # an event stream if asked for one, otherwise a long poll
+        # either way resume from the Last-Event-ID header or ?since=, a 'resync' means refetch /manifest and /hosts
+        resume=cherrypy.request.headers.get("Last-Event-ID",since)
+        try:
+            seq=int(resume) if resume is not None else self._changes.latest()
+        except ValueError:
+            raise cherrypy.HTTPError(400, "since should be a change number")
+
+        cherrypy.response.headers["Cache-Control"]="no-cache"
+
+        # a watcher parks a thread for up to CHANGES_LONG_POLL, or for good if it streams - past the limit they come back later
+        # rather than starve /manifest and /hosts
+        if not self.startWatching():
+            metrics.inc("espupdate_changes_refused_total")
+            cherrypy.response.status=503
+            cherrypy.response.headers["Retry-After"]=str(CHANGES_KEEPALIVE)
+            return "Busy"
+        cherrypy.request.hooks.attach('on_end_request', self.stopWatching)
+
+        if "text/event-stream" in cherrypy.request.headers.get("Accept",""):
+            cherrypy.response.headers["Content-Type"]="text/event-stream"
+            cherrypy.response.stream=True
+            return self._changeStream(seq)
+
+        if self._changes.since(seq)==[]:
+            self._changes.wait(seq, CHANGES_LONG_POLL)
+
+        cherrypy.response.headers["Content-Type"]="application/json"
+        return self._changeBatch(seq)
+
+    def startWatching(self):
+        with self._watchLock:
+            if self._watching>=self._haconfig["changes_limit"]:
+                return False
+            self._watching+=1
+            return True
+
+    def stopWatching(self):
+        with self._watchLock:
+            self._watching-=1
+
+    def _changeBatch(self, seq):
+        latest=self._changes.latest()
+        changes=self._changes.since(seq)
+        if changes is None:
+            return json.dumps({ "seq":latest, "resync":True }).encode()
+        return json.dumps({ "seq":max([latest]+[x["seq"] for x in changes]), "changes":changes }).encode()
+
+    def _changeStream(self, seq):
+
+        # holds a server thread for as long as the client listens
+        yield "retry: 5000\n\n".encode()
+
+        while not self._changes.closed() and not self._stop.is_set():
+
+            changes=self._changes.since(seq)
+
+            if changes is None:
+                seq=self._changes.latest()
+                yield "id: {}\nevent: resync\ndata: {{}}\n\n".format(seq).encode()
+                continue
+
+            for each in changes:
+                seq=each["seq"]
+                yield "id: {}\nevent: {}\ndata: {}\n\n".format(seq, each["type"], json.dumps(each)).encode()
+
+            if not self._changes.wait(seq, CHANGES_KEEPALIVE) and not self._changes.closed():
+                yield ": keep-alive\n\n".encode()
 
     @cherrypy.expose
     def updateBinary(self,**params):
+        self.measureRequest("updateBinary")
         return self.sendUpdateFile("bin")
 
     @cherrypy.expose
     def updateSpiffs(self,**params):
+        self.measureRequest("updateSpiffs")
         return self.sendUpdateFile("spiffs")
 
+    @cherrypy.expose
+    def metrics(self):
+        cherrypy.response.headers["Content-Type"]="text/plain; version=0.0.4"
+        return metrics.render()
+
+    def measureRequest(self, endpoint):
+
+        # counted once the response has gone, so slow transfers show in the latency
+        started=time.time()
+
+        def done():
+            status=str(cherrypy.response.status or 200)[:3]
+            metrics.inc("espupdate_http_requests_total", endpoint=endpoint, status=status)
+            metrics.observe("espupdate_http_request_seconds", time.time()-started, endpoint=endpoint, status=status)
+
+        cherrypy.request.hooks.attach('on_end_request', done)
+
+    @cherrypy.expose
+    def rollout(self):
+        return json.dumps(self._rollout.status(), indent=4)
+
+    @cherrypy.expose
+    def rollback(self, channel=None, tag=None, **params):
+
+        # put a channel back to a tag we still hold, and keep it there - without a tag, follow github again
+        if self._follower:
+            raise cherrypy.HTTPError(409, "roll back on the cluster leader, {}".format(self._leader))
+
+        if channel not in self._config["manifest"]:
+            raise cherrypy.HTTPError(404, "no such channel")
+
+        if tag is None:
+            Node=dict(self._config["manifest"][channel])
+            if Node.pop("pinned",None):
+                self._switchChannel(channel, Node)
+        elif tag==self._config["manifest"][channel]["tag_name"]:
+            Node=dict(self._config["manifest"][channel], pinned=True)
+            self._switchChannel(channel, Node)
+        elif not self._restoreFromHistory(channel, tag, pinned=True):
+            raise cherrypy.HTTPError(404, "{} isn't held for {}".format(tag,channel))
+
+        cherrypy.response.headers["Content-Type"]="application/json"
+        return json.dumps(self._config["manifest"][channel], indent=4).encode()
+
+    @cherrypy.expose
+    def blobs(self, digest=None, **params):
+        # cluster followers mirror images from here
+        if digest is None or not BLOB_RE.fullmatch(digest) or not self._blobs.has(digest):
+            raise cherrypy.HTTPError(404)
+        return cherrypy.lib.static.serve_file(self._blobs.path(digest), "application/octet-stream")
+
+    @cherrypy.expose
+    def family(self, name=None, **params):
+
+        # a follower has devices of this hardware, fetch what we skipped of it
+        if name is None or not self.knownFamily(name):
+            raise cherrypy.HTTPError(404, "no firmware for that hardware")
+
+        self.wantFamily(name)
+
+        return "OK"
+
+    @cherrypy.expose
+    def cluster(self):
+        cherrypy.response.headers["Content-Type"]="application/json"
+        hosts=self._devices.snapshot()
+        owned=[x["name"] for x in hosts if self.ownsDevice(x)]
+        return json.dumps({ "self":self._haconfig["cluster_self"], "leader":self._leader, "nodes":self._haconfig["cluster_nodes"], "devices":owned, "seen":[x["name"] for x in hosts] }, indent=4).encode()
+
     @cherrypy.expose
     def upgradeAll(self):
         self._updatePending=True
+        self._wake.set()
         return 
 
     @cherrypy.expose
@@ -729,7 +2587,7 @@ class RepoReleases:
 
 
         # then carve it up
-        deviceVersion=self.crackVersion(hardware[1])
+        deviceVersion=Version.parse(hardware[1])
 
         if deviceVersion is None:
             # malformed 
@@ -737,12 +2595,6 @@ class RepoReleases:
             logger.warning("HTTPUpdate - Error - malformed version")
             return "Error - malformed version"
 
-        # check if we're polling
-        if self._polling==True:
-            logger.warning("HTTPUpdate - Busy")
-            cherrypy.response.status=503
-            return "Busy"
-
         macAddress = cherrypy.request.headers.get('X-Esp8266-Sta-Mac')
         #logger.info(cherrypy.request.headers)
         logger.info("Heard from %s - %s",currentDeviceVer, macAddress) 
@@ -798,7 +2650,7 @@ class RepoReleases:
             return "Error - malformed hardware|version"
 
         # then carve it up
-        deviceVersion=self.crackVersion(hardware[1])
+        deviceVersion=Version.parse(hardware[1])
 
         # check for prerelease request
         logger.debug("nightly requested %s",prereleaseRequested)
@@ -811,56 +2663,308 @@ class RepoReleases:
             return "Error - malformed version"
 
 
-        # check if we're polling
-        if self._polling==True:
-            logger.warning("HTTPUpdate - Busy")
-            cherrypy.response.status=503
-            return "Busy"
-
         # sort out which branch to pass to them
         asset_dir="nightly" if prereleaseRequested==True else "releases"
 
-        Node = self._config["manifest"][asset_dir]
+        # read once, a publish between the tag check and the lookup could otherwise pair an old tag with new firmware
+        firmware, tags = self._served
+        tag = tags.get(asset_dir)
 
-        if "tag_name" not in Node or not self.vgreater(deviceVersion,self.crackVersion(Node["tag_name"])):
+        if tag is None or deviceVersion>=tag:
             cherrypy.response.status=304
             logger.info("No upgrade available for %s",deviceVersion)
             return "No upgrade"
 
+        self.noteFamily(hardware[0])
 
-        # now we have to carve the hardware
-        lookfor=hardware[0]+"-.*\\."+fileTail+"$"
-        r=re.compile(lookfor)
-        newlist = list(filter(r.match, Node["files"])) # Read Note
+        # now we have to find the hardware
+        entry = firmware.get((asset_dir, hardware[0], fileTail))
+
+        # hardware we didn't extract, fetch it and have them come back
+        if entry is None and hardware[0] in self._config["manifest"].get(asset_dir,{}).get("deferred",{}):
+            self.fetchDeferred(asset_dir, hardware[0])
+            cherrypy.response.status=503
+            cherrypy.response.headers["Retry-After"]=str(DEFERRED_RETRY)
+            logger.info("HTTPUpdate - fetching %s %s, come back later",asset_dir,hardware[0])
+            return "Fetching"
 
         #should only be one candidate
-        if len(newlist)!=1:
+        if entry is None:
             cherrypy.response.status=500
             logger.warning("HTTPUpdate - No candidate")
             return "No candidate"
 
-        # TODO remove this
-        # logger.info("Would have served them a file {}".format(newlist[0]))
+        macAddress = cherrypy.request.headers.get('X-Esp8266-Sta-Mac')
+        #logger.info(cherrypy.request.headers)
+        logger.info("Heard from %s - %s",currentDeviceVer, macAddress) 
 
-        # cherrypy.response.status=500
-        # logger.warning("HTTPUpdate - No candidate")
-        # return "No candidate"
+        self._devices.heardFrom(cherrypy.request.remote.ip, macAddress)
 
+        # devices that can flash a gzipped image get the smaller one
+        if entry.get("gz") is not None and self.deviceTakesGzip(hardware[0], deviceVersion):
+            entry=entry["gz"]
 
+        name= entry["path"]
 
+        logger.info("returning %s",name)
 
-        macAddress = cherrypy.request.headers.get('X-Esp8266-Sta-Mac')
-        #logger.info(cherrypy.request.headers)
-        logger.info("Heard from %s - %s",currentDeviceVer, macAddress) 
+        return self.serveFirmware(entry)
 
-        name= os.path.join(os.path.join(DATA_STEM,asset_dir),newlist[0])
+    def deviceTakesGzip(self, hardware, deviceVersion):
 
-        logger.info("returning %s",name)
+        if not self._haconfig["gzip"] or hardware not in self._haconfig["gzip_hardware"]:
+            return False
 
-        basename = os.path.basename(name)
-        filename = name
-        mime     = 'application/octet-stream'
-        return cherrypy.lib.static.serve_file(filename, mime, basename)
+        minimum=Version.parse(self._haconfig["gzip_min_version"])
+
+        return minimum is not None and deviceVersion>=minimum
+
+    def serveFirmware(self, entry):
+
+        try:
+            data=self._cache.load(entry["path"], entry["stamp"])
+        except OSError as e:
+            # only if a new set was published between the lookup and here
+            logger.warning("HTTPUpdate - %s went away - %s",entry["name"],e)
+            cherrypy.response.status=503
+            cherrypy.response.headers["Retry-After"]="1"
+            return "Busy"
+
+        # strong validator, so a retrying device or a proxy can resume rather than start again
+        etag=entry["etag"]
+        size=entry["size"]
+
+        headers=cherrypy.response.headers
+
+        ifNoneMatch=cherrypy.request.headers.get("If-None-Match")
+        if ifNoneMatch is not None and (ifNoneMatch.strip()=="*" or etag in [x.strip() for x in ifNoneMatch.split(",")]):
+            headers["ETag"]=etag
+            cherrypy.response.status=304
+            logger.info("%s not modified",entry["name"])
+            return ""
+
+        # cheap answers are done, this one holds a thread for as long as the device takes
+        client=cherrypy.request.headers.get("X-Esp8266-Sta-Mac") or cherrypy.request.remote.ip
+        admitted, position, retry = self._transfers.admit(client)
+        if not admitted:
+            metrics.inc("espupdate_transfers_refused_total")
+            logger.info("HTTPUpdate - %s is number %s in the queue, back in %ss",client,position,retry)
+            cherrypy.response.status=503
+            headers["Retry-After"]=str(retry)
+            headers["X-Queue-Position"]=str(position)
+            return "Busy"
+
+        started=time.time()
+        cherrypy.request.hooks.attach('on_end_request', lambda: self._transfers.end(time.time()-started))
+
+        headers["Content-Type"]="application/octet-stream"
+        headers["Content-Disposition"]='attachment; filename="{}"'.format(entry["name"])
+        headers["ETag"]=etag
+        headers["Accept-Ranges"]="bytes"
+
+        start=0
+        length=size
+
+        # If-Range means 'only resume if it's still the same image'
+        rangeHeader=cherrypy.request.headers.get("Range")
+        ifRange=cherrypy.request.headers.get("If-Range")
+        if rangeHeader is not None and (ifRange is None or ifRange.strip()==etag):
+
+            byteRange=_parseRange(rangeHeader,size)
+
+            if byteRange is False:
+                cherrypy.response.status=416
+                headers["Content-Range"]="bytes */{}".format(size)
+                logger.warning("HTTPUpdate - unsatisfiable range %s for %s",rangeHeader,entry["name"])
+                return ""
+
+            if byteRange is not None:
+                start, length = byteRange
+                cherrypy.response.status=206
+                headers["Content-Range"]="bytes {}-{}/{}".format(start,start+length-1,size)
+                logger.info("resuming %s from %s",entry["name"],start)
+
+        headers["Content-Length"]=str(length)
+
+        # the esp updater checks the whole image against this before it flashes
+        if length==size:
+            headers["x-MD5"]=entry["md5"]
+
+        cherrypy.response.stream=True
+        if self._haconfig["transfer_budget_kb"]>0:
+            return self._counted(entry, self._paced(data, start, length))
+        if length==len(data):
+            # the cached image goes to the socket as is, no copy
+            return self._counted(entry, [data])
+        return self._counted(entry, [data[start:start+length]])
+
+    def _counted(self, entry, chunks):
+        # the server only asks for the next chunk once this one is written, so an aborted transfer counts what got out
+        channel, hardware, kind = entry["key"]
+        for chunk in chunks:
+            yield chunk
+            metrics.inc("espupdate_served_bytes_total", len(chunk), channel=channel, hardware=hardware, kind=kind)
+
+
+    def _paced(self, data, start, length):
+        for offset in range(start, start+length, TRANSFER_CHUNK):
+            chunk=data[offset:min(offset+TRANSFER_CHUNK,start+length)]
+            self._transfers.spend(len(chunk))
+            yield chunk
+
+    def threadPool(self):
+        # a transfer for every slot, and the rest kept for /hosts, /manifest and the like
+        return self._haconfig["transfer_limit"]+self._haconfig["control_threads"]
+
+
+def _extractMembers(tf, osdir, files, compress=False, hashes=None, wanted=None, skipped=None):
+
+    # tf is a streaming tarfile, write out the plain files and note them in files
+    # compress leaves a .gz beside each image - those aren't listed in files
+    # hashes gets (md5, sha256) of everything written, worked out on the way through
+    # firmware for hardware not in wanted isn't written, it's noted in skipped
+    for member in tf:
+
+        if not member.isfile():
+            continue
+
+        name=member.name
+        if name!=os.path.basename(name) or name.startswith("."):
+            logger.warning("Skipping tar member %s",name)
+            continue
+
+        if wanted is not None and name[name.rfind(".")+1:] in FIRMWARE_KINDS and _family(name) not in wanted:
+            if skipped is not None:
+                skipped.append(name)
+            continue
+
+        # write beside the target then rename, nobody sees half a file
+        target=os.path.join(osdir,name)
+        fd, staged = tempfile.mkstemp(dir=osdir, prefix=".extract-")
+        md5=hashlib.md5()
+        sha=hashlib.sha256()
+        try:
+            with os.fdopen(fd,"wb") as out:
+                source=tf.extractfile(member)
+                for chunk in iter(lambda: source.read(1024*1024), b""):
+                    md5.update(chunk)
+                    sha.update(chunk)
+                    out.write(chunk)
+            os.replace(staged,target)
+        finally:
+            if os.path.exists(staged):
+                os.unlink(staged)
+
+        logger.debug("Extracted %s",target)
+        files.append(name)
+        if hashes is not None:
+            hashes[name]=(md5.hexdigest(), sha.hexdigest())
+
+        if compress and name[name.rfind(".")+1:] in FIRMWARE_KINDS:
+            _gzipBeside(target)
+            if hashes is not None and os.path.isfile(target+".gz"):
+                hashes[name+".gz"]=_fileHashes(target+".gz")
+
+
+def _gzipBeside(path):
+
+    # the esp8266 updater inflates the image itself, so it's served as is - not as a Content-Encoding
+    fd, staged = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".extract-")
+    try:
+        with open(path,"rb") as raw, os.fdopen(fd,"wb") as out:
+            with gzip.GzipFile(filename="", mode="wb", compresslevel=9, fileobj=out, mtime=0) as gz:
+                shutil.copyfileobj(raw, gz)
+
+        # not worth having if it isn't smaller
+        if os.path.getsize(staged)<os.path.getsize(path):
+            os.replace(staged, path+".gz")
+            logger.debug("Compressed %s to %s bytes",path,os.path.getsize(path+".gz"))
+    finally:
+        if os.path.exists(staged):
+            os.unlink(staged)
+
+
+def _releaseSummary(release):
+    # the parts of a github release we use, remembered between polls
+    return { "id":release["id"], "tag_name":release["tag_name"], "name":release.get("name"), "draft":release.get("draft",False), "prerelease":release.get("prerelease",False),
+            "assets":[{ "name":x["name"], "browser_download_url":x["browser_download_url"] } for x in release.get("assets",[])] }
+
+
+def _artifactTag(name):
+    # wemosD1-v1.2.3.nightly -> v1.2.3.nightly, None if it isn't a firmware artifact
+    parts=name.split("-")
+    if len(parts)<2 or parts[0]=="" or Version.parse(parts[1]) is None:
+        return None
+    return parts[1]
+
+
+def _family(name):
+    # wemosD1-v1.2.3.bin -> wemosD1, the same goes for artifact names
+    return name[:name.find("-")] if name.find("-")>0 else name
+
+
+def _fileDigest(path):
+    return _fileHashes(path)[1]
+
+
+def _fileHashes(path):
+    # (md5, sha256)
+    md5=hashlib.md5()
+    sha=hashlib.sha256()
+    with open(path,"rb") as fd:
+        for chunk in iter(lambda: fd.read(1024*1024), b""):
+            md5.update(chunk)
+            sha.update(chunk)
+    return md5.hexdigest(), sha.hexdigest()
+
+
+def _ringHash(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8],"big")
+
+
+def _parseRange(rangeHeader, size):
+
+    # returns (start, length), None to ignore the header and send it all, or False if unsatisfiable
+    units, _, spec = rangeHeader.partition("=")
+    if units.strip()!="bytes" or spec.find(",")!=-1:
+        # we only do single byte ranges
+        return None
+
+    first, dash, last = spec.strip().partition("-")
+    if dash!="-":
+        return None
+
+    try:
+        if first=="":
+            # suffix range, the last n bytes
+            count=int(last)
+            if count<=0:
+                return False
+            start=max(0,size-count)
+            end=size-1
+        else:
+            start=int(first)
+            if start>=size:
+                return False
+            end=int(last) if last!="" else size-1
+            if end<start:
+                return None
+            end=min(end,size-1)
+    except ValueError:
+        return None
+
+    return (start, end-start+1)
+
+
+# the same handful of versions get parsed over and over, remember them
+@functools.lru_cache(maxsize=1024)
+def _parseVersion(vstring):
+
+    parts=VERSION_RE.fullmatch(vstring)
+    if parts is None:
+        return None
+
+    return Version(vstring, (int(parts.group(1)),int(parts.group(2)),int(parts.group(3))), parts.group(4))
 
 
 if LOG_FILE is not None:
@@ -884,16 +2988,12 @@ if __name__ == '__main__':
 
     myrels=RepoReleases("barneyman","ESP8266-Light-Switch")
 
-    main_running=True
-
     def signal_handler(sig, frame):
 
-        global main_running
         logger.warning("Detected SIGINT")
         # stop my thread
         myrels.stopPoller()
         cherrypy.engine.exit()
-        main_running=False
 
     signal.signal(signal.SIGINT, signal_handler)
 
@@ -902,12 +3002,11 @@ if __name__ == '__main__':
 
         cherrypy.config.update({'server.socket_port': myrels.port()})
         cherrypy.config.update({'server.socket_host' : '0.0.0.0'})
+        cherrypy.config.update({'server.thread_pool' : myrels.threadPool()})
 
+        # blocks until the engine exits
         cherrypy.quickstart(myrels)
 
-        while main_running:
-            time.sleep(2)
-
     except Exception as e:
 
         logger.error(e)